@@ -0,0 +1,107 @@
+"""
+asyncio engine for the simulator, an alternative to the Twisted reactor loop in twisted_server.py.
+
+The asyncio event loop runs on its own thread and does all network I/O and message decoding. The
+simulation and rendering run on the calling (main) thread, so pygame keeps its window on the main thread
+and a slow frame never holds up the sockets. The two threads only meet through deques, whose append and
+popleft are atomic:
+    inbound: messages are decoded on the event loop, publishes included, and handed to RosSimulator.call_soon
+        to run at the start of the next frame
+    outbound: encoded sensor messages go into each client's outbox and are flushed by the event loop,
+        keeping only the latest message of each topic while the client's write buffer is over the high-water mark
+
+Usage:
+    python create3_simulator.py --engine asyncio
+or from code:
+    asyncio_server.run(ros, port)
+"""
+import asyncio
+import signal
+import threading
+from collections import deque
+
+from autobahn.asyncio.websocket import WebSocketServerFactory, WebSocketServerProtocol
+
+from rosbridge import RosbridgeProtocol
+
+
+class AsyncioProtocol(RosbridgeProtocol, WebSocketServerProtocol):
+    """
+    A rosbridge client on the asyncio event loop. Simulator state is only touched on the simulation thread,
+    through ros.call_soon; send_encoded is called on the simulation thread and only queues.
+    """
+    # every frame is decoded here on the event loop, the simulation thread only applies it
+    lazy_publish = False
+
+    def __init__(self, ros_instance):
+        super().__init__(ros_instance)
+        self.outbox = deque() # (topic name, data, is_binary) from the simulation thread
+        self.flush_scheduled = False
+        self.loop = None
+
+    def onConnect(self, request):
+        self.peer = request.peer
+        print(f'CONNECTED to {request.peer}')
+
+    def onOpen(self):
+        self.loop = asyncio.get_running_loop()
+        self.transport.set_write_buffer_limits(high=self.ros.client_high_water)
+        self.ros.call_soon(self.ros.add_client, self)
+
+    def onClose(self, wasClean, code, reason):
+        print(f'DISCONNECTED from {self.peer}')
+        self.ros.call_soon(self.ros.remove_client, self)
+
+    def onMessage(self, payload, isBinary):
+        self.ros.call_soon(self.receive(payload, isBinary))
+
+    def send_encoded(self, data, is_binary=False, topic_name=None):
+        # simulation thread: queue the message and wake the event loop if it is not already going to flush
+        self.outbox.append((topic_name, data, is_binary))
+        if not self.flush_scheduled and self.loop is not None:
+            self.flush_scheduled = True
+            self.loop.call_soon_threadsafe(self.flush)
+
+    def flush(self):
+        # event loop thread: send what the simulation queued, coalescing per topic while paused
+        self.flush_scheduled = False
+        while self.outbox:
+            topic_name, data, is_binary = self.outbox.popleft()
+            if self.paused or self.transport is None:
+                self.queue_latest(topic_name, data, is_binary)
+            else:
+                self.write_message(data, is_binary)
+
+    def pause_writing(self):
+        # asyncio: the transport buffer is over the high-water mark
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.send_pending()
+
+
+def serve(ros, port, ip='0.0.0.0'):
+    # start the event loop thread serving ros on ip:port (0 picks a free port), returns (loop, port)
+    loop = asyncio.new_event_loop()
+    factory = WebSocketServerFactory(f"ws://{ip}:{port}" if port else f"ws://{ip}", loop=loop)
+    factory.protocol = lambda: AsyncioProtocol(ros)
+    server = loop.run_until_complete(loop.create_server(factory, ip, port))
+    threading.Thread(target=loop.run_forever, name='ros-io', daemon=True).start()
+    return loop, server.sockets[0].getsockname()[1]
+
+
+def run(ros, port, ip='0.0.0.0'):
+    # serve ros and run its frame loop on this thread until the simulator exits
+    loop, port = serve(ros, port, ip)
+    # SDL turns SIGTERM into a QUIT event, which headless simulators never read
+    signal.signal(signal.SIGTERM, lambda signum, frame: setattr(ros, 'running', False))
+    try:
+        while ros.running:
+            if ros.paused:
+                # lockstep: run as soon as a client calls /sim/step instead of at the next frame
+                ros.wait_inbox(1 / ros.render_rate)
+            ros.run_once()
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        ros.close()
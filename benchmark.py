@@ -0,0 +1,279 @@
+"""
+Benchmarks for the simulator hot paths. Runs headless (SDL dummy drivers), so it works on any Linux box.
+
+Results are printed and can be saved as JSON to compare between commits:
+    python benchmark.py --robots 1 10 100 --map-size 1000 2000 --out after.json
+    python benchmark.py --compare before.json after.json
+"""
+import os
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import create3_simulator as sim
+import ros_messages
+import rosbridge
+import shm_export
+
+
+class NullClient:
+    # stands in for a WebSocket client subscribed to every sensor topic, so publishing does all its work
+    def __init__(self):
+        self.bytes_sent = 0
+
+    def send_encoded(self, data, is_binary=False, topic_name=None):
+        self.bytes_sent += len(data)
+
+
+def measure(fn, min_time=0.5, max_iterations=100000):
+    # time single calls of fn until min_time seconds have passed, returns stats in microseconds
+    durations = []
+    deadline = time.perf_counter() + min_time
+    while len(durations) < max_iterations and (len(durations) < 5 or time.perf_counter() < deadline):
+        start = time.perf_counter_ns()
+        fn()
+        durations.append(time.perf_counter_ns() - start)
+    durations.sort()
+    return {
+        'iterations': len(durations),
+        'mean_us': statistics.fmean(durations) / 1000,
+        'median_us': durations[len(durations) // 2] / 1000,
+        'p95_us': durations[int(len(durations) * 0.95)] / 1000,
+        'min_us': durations[0] / 1000,
+    }
+
+
+def make_simulator(robots, map_size, headless=True):
+    names = [f'robot{i}' for i in range(robots)]
+    ros = sim.RosSimulator(names, headless=headless, real_time_factor=0, size=(map_size, map_size))
+    client = NullClient()
+    for robot in ros.robots:
+        robot.cmd_vel_topic.publish({'linear': {'x': 0.2}, 'angular': {'z': 0.5}})
+        for topic in (robot.odom_topic, robot.imu_topic, robot.ir_topic):
+            ros.subscribe_client(client, topic.topic_name)
+    return ros
+
+
+def bench_simulator(robots, map_size, min_time):
+    # benchmarks whose cost grows with the number of robots and the map size
+    ros = make_simulator(robots, map_size)
+    results = {
+        'fleet_update': measure(lambda: ros.fleet.update(ros.physics_dt), min_time),
+        'step': measure(ros.step, min_time),
+        'run_once_headless': measure(ros.run_once, min_time),
+    }
+    exporter = shm_export.SharedStateExporter(ros, f'create3_bench_{os.getpid()}')
+    reader = shm_export.SharedStateReader(exporter.name)
+    results['shm_export_write'] = measure(exporter.write, min_time)
+    results['shm_export_read'] = measure(reader.read, min_time)
+    reader.close()
+    exporter.close()
+    ros = make_simulator(robots, map_size, headless=False)
+    results['run_once_render'] = measure(ros.run_once, min_time)
+    return results
+
+
+def bench_robot(map_size, min_time):
+    # benchmarks of a single robot's methods
+    ros = make_simulator(1, map_size)
+    robot = ros.main_robot
+    cmd_vel = {'linear': {'x': 0.2, 'y': 0.0, 'z': 0.0}, 'angular': {'x': 0.0, 'y': 0.0, 'z': 0.5}}
+    lights = {'leds': [{'red': 255, 'green': 0, 'blue': 255}] * 6, 'override_system': True}
+    # an inbound cmd_vel frame as roslibpy sends it, through the rosbridge dispatch and then read by the physics
+    client = rosbridge.RosbridgeProtocol(ros)
+    frame = ros_messages.dumps({'op': 'publish', 'id': 'publish:/robot0/cmd_vel:1', 'topic': '/robot0/cmd_vel', 'msg': cmd_vel, 'latch': False})
+    return {
+        'check_collision': measure(lambda: robot.check_collision(robot.x, robot.y), min_time),
+        'measure_IR': measure(lambda: robot.measure_IR(robot.x, robot.y), min_time),
+        'publish_odom': measure(robot.publish_odom, min_time),
+        'publish_imu': measure(robot.publish_imu, min_time),
+        'publish_ir': measure(robot.publish_ir, min_time),
+        'topic_publish_cmd_vel': measure(lambda: robot.cmd_vel_topic.publish(cmd_vel), min_time),
+        'topic_publish_lightring': measure(lambda: (robot.light_topic.publish(lights), ros.run_inbox()), min_time),
+        'rosbridge_receive_cmd_vel': measure(lambda: client.receive(frame, False)(), min_time),
+        'rosbridge_receive_and_read': measure(lambda: (client.receive(frame, False)(), robot.read_cmd_vel()), min_time),
+    }
+
+
+def bench_ws_latency(samples):
+    # end to end latency from sending cmd_vel on a local WebSocket client to receiving an odom with that velocity
+    from autobahn.twisted.websocket import WebSocketClientFactory, WebSocketClientProtocol
+    from twisted.internet import reactor, task
+
+    ros = sim.RosSimulator('bench', headless=True, publish_rates={'odom': 200})
+    import twisted_server
+    port = twisted_server.listen(ros, 0, '127.0.0.1').getHost().port
+    task.LoopingCall(ros.run_with_exit, reactor).start(ros.loop_interval)
+    latencies = []
+
+    class LatencyClient(WebSocketClientProtocol):
+        def onOpen(self):
+            self.sendMessage(ros_messages.dumps({'op': 'subscribe', 'topic': '/bench/odom', 'type': 'nav_msgs/Odometry'}))
+            self.count = 0
+            self.send_cmd_vel()
+
+        def send_cmd_vel(self):
+            # every command has a unique (tiny) velocity so we can spot the odom that reflects it
+            self.count += 1
+            self.v = self.count * 1e-6
+            self.sent = time.perf_counter()
+            self.sendMessage(ros_messages.dumps({'op': 'publish', 'topic': '/bench/cmd_vel',
+                                                 'msg': {'linear': {'x': self.v}, 'angular': {'z': 0.0}}}))
+
+        def onMessage(self, payload, isBinary):
+            msg = ros_messages.loads(payload)
+            if len(latencies) >= samples or msg['msg']['twist']['twist']['linear']['x'] != self.v:
+                return
+            latencies.append((time.perf_counter() - self.sent) * 1e6)
+            if len(latencies) >= samples:
+                reactor.stop()
+            else:
+                self.send_cmd_vel()
+
+    factory = WebSocketClientFactory(f'ws://127.0.0.1:{port}')
+    factory.protocol = LatencyClient
+    reactor.connectTCP('127.0.0.1', port, factory)
+    reactor.callLater(60, reactor.stop) # never hang
+    reactor.run()
+
+    if not latencies:
+        return {'iterations': 0}
+    latencies.sort()
+    return {
+        'iterations': len(latencies),
+        'mean_us': statistics.fmean(latencies),
+        'median_us': latencies[len(latencies) // 2],
+        'p95_us': latencies[int(len(latencies) * 0.95)],
+        'min_us': latencies[0],
+    }
+
+
+# run in a fresh interpreter: import the simulator and build it, print the timings as JSON
+STARTUP_SCRIPT = '''
+import json, sys, time
+started = time.perf_counter()
+import create3_simulator as sim
+imported = time.perf_counter()
+ros = sim.RosSimulator([f'robot{i}' for i in range(int(sys.argv[1]))], headless=True, size=(int(sys.argv[2]),) * 2)
+print(json.dumps({'import_ms': (imported - started) * 1e3, 'total_ms': (time.perf_counter() - started) * 1e3, **ros.startup_ms}))
+'''
+
+
+def bench_startup(robots, map_size, runs):
+    # wall time from starting the interpreter to a ready simulator, with an empty and with a filled asset cache
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = {**os.environ, 'CREATE3_SIM_CACHE': cache_dir}
+        for name, count in (('startup_cold_cache', 1), ('startup_warm_cache', runs)):
+            durations, stages = [], []
+            for _ in range(count):
+                start = time.perf_counter()
+                output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, str(robots), str(map_size)], env=env, capture_output=True,
+                                        text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+                durations.append((time.perf_counter() - start) * 1e6)
+                stages.append(json.loads(output.splitlines()[-1]))
+            durations.sort()
+            results[name] = {
+                'iterations': count,
+                'mean_us': statistics.fmean(durations),
+                'median_us': durations[len(durations) // 2],
+                'min_us': durations[0],
+                # in ms, of the median run: import, simulator constructor stages (see RosSimulator.startup_ms)
+                'stages_ms': stages[durations.index(durations[len(durations) // 2])],
+            }
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def run(args):
+    results = []
+
+    def add(name, stats, robots=1, map_size=None):
+        results.append({'name': name, 'robots': robots, 'map_size': map_size, **stats})
+        print(f"{name:<26} robots={robots:<4} map={str(map_size):<5} "
+              f"median={stats.get('median_us', float('nan')):10.1f} us  mean={stats.get('mean_us', float('nan')):10.1f} us")
+
+    for map_size in args.map_size:
+        for name, stats in bench_robot(map_size, args.min_time).items():
+            add(name, stats, 1, map_size)
+        for robots in args.robots:
+            for name, stats in bench_simulator(robots, map_size, args.min_time).items():
+                add(name, stats, robots, map_size)
+
+    if args.startup_runs:
+        for map_size in args.map_size:
+            for robots in args.robots:
+                for name, stats in bench_startup(robots, map_size, args.startup_runs).items():
+                    add(name, stats, robots, map_size)
+
+    # the reactor can only run once per process, so this goes last
+    if not args.skip_websocket:
+        add('ws_cmd_vel_to_odom', bench_ws_latency(args.latency_samples))
+
+    return {
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+
+def compare(before_path, after_path):
+    # print the median time ratio after/before for every benchmark found in both files
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    key = lambda r: (r['name'], r['robots'], r['map_size'])
+    baseline = {key(r): r for r in before['results']}
+    print(f"{before.get('commit', before_path)} -> {after.get('commit', after_path)}")
+    for result in after['results']:
+        old = baseline.get(key(result))
+        if not old or not old.get('median_us') or 'median_us' not in result:
+            continue
+        ratio = result['median_us'] / old['median_us']
+        print(f"{result['name']:<26} robots={result['robots']:<4} map={str(result['map_size']):<5} "
+              f"{old['median_us']:10.1f} -> {result['median_us']:10.1f} us  x{ratio:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Create3 simulator hot paths')
+    parser.add_argument('--robots', type=int, nargs='+', default=[1, 10, 50], help='robot counts to benchmark')
+    parser.add_argument('--map-size', type=int, nargs='+', default=[1000], help='square map sizes in pixels')
+    parser.add_argument('--min-time', type=float, default=0.5, help='seconds spent on each benchmark')
+    parser.add_argument('--latency-samples', type=int, default=100, help='cmd_vel -> odom round trips to time')
+    parser.add_argument('--startup-runs', type=int, default=3, help='simulator startups to time in fresh processes, 0 skips them')
+    parser.add_argument('--skip-websocket', action='store_true', help='skip the WebSocket latency benchmark')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two result files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = run(args)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results written to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
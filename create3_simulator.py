@@ -1,16 +1,424 @@
 import pygame
 from pygame.locals import *
-from math import cos, sin, degrees, radians, pi
-import json
-from autobahn.twisted.websocket import WebSocketServerFactory, WebSocketServerProtocol
-from twisted.internet import reactor, task
+from math import cos, sin, degrees, radians, pi, isfinite
+import ros_messages
+import sim_recorder
+import sim_map
+import sim_assets
 import random
 import numpy
 import threading
+import functools
+import weakref
+from collections import deque
 import time
 import os
+import argparse
 
 
+def ir_rays(px, py, theta, angles, radius):
+    """
+    Returns (origins, directions) of the IR rays, each of shape (..., len(angles), 2) in pixels.
+    px, py and theta may be scalars for one robot or arrays of shape (N,) for many robots,
+    radius a scalar or an array of shape (N, 1, 1). Screen y points down, so the y components are negated.
+    """
+    px, py, theta = (numpy.asarray(a, dtype=float)[..., None] for a in (px, py, theta))
+    ray_angles = theta + angles
+    directions = numpy.stack((numpy.cos(ray_angles), -numpy.sin(ray_angles)), axis=-1)
+    centers = numpy.stack(numpy.broadcast_arrays(px, py), axis=-1)
+    return centers + radius * directions, directions
+
+def cast_rays(wall_map, origins, directions, max_range, step=1.0):
+    """
+    Casts any number of rays over the occupancy grid wall_map (indexed [x, y]) in one batched pass.
+    origins and directions have shape (..., 2) in pixels. Each ray is sampled every step pixels,
+    and the result is the distance of the first sample (step, 2*step, ...) that lands on a wall, or
+    that of the last sample (ceil(max_range) for step 1) if nothing is hit. Anything off the map counts as a wall.
+    """
+    origins = numpy.asarray(origins, dtype=float)
+    directions = numpy.asarray(directions, dtype=float)
+    steps = max(int(numpy.ceil(max_range / step - 1e-9)), 0)
+    if steps == 0:
+        return numpy.zeros(origins.shape[:-1])
+
+    distance = numpy.arange(1, steps + 1, dtype=float) * step
+    # astype truncates toward zero, the same as int()
+    x = (origins[..., 0, None] + directions[..., 0, None] * distance).astype(numpy.intp)
+    y = (origins[..., 1, None] + directions[..., 1, None] * distance).astype(numpy.intp)
+    width, height = wall_map.shape
+    inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+    hit = numpy.where(inside, wall_map[numpy.clip(x, 0, width - 1), numpy.clip(y, 0, height - 1)], True)
+
+    first_hit = (hit.argmax(axis=-1) + 1) * step
+    return numpy.where(hit.any(axis=-1), first_hit, steps * step).astype(float)
+
+# part of the cached wall distances' key (see RosSimulator.set_background), bump it whenever distance_transform changes
+DISTANCE_TRANSFORM_VERSION = 1
+
+def distance_transform(wall_map, max_distance):
+    """
+    Euclidean distance in pixels from every cell of wall_map to the nearest wall cell, clamped at
+    max_distance. Everything off the map counts as a wall. Computed once per map: an exact
+    distance along each column first, then the minimum over horizontal offsets up to max_distance.
+    """
+    cap = int(numpy.ceil(max_distance))
+    walls = numpy.pad(wall_map, 1, constant_values=True)
+    height = walls.shape[1]
+
+    # distance along y to the closest wall above and below (the padding guarantees there is one)
+    index = numpy.arange(height)
+    above = numpy.maximum.accumulate(numpy.where(walls, index, 0), axis=1)
+    below = numpy.minimum.accumulate(numpy.where(walls, index, height)[:, ::-1], axis=1)[:, ::-1]
+    column = numpy.minimum(numpy.minimum(index - above, below - index), cap + 1).astype(numpy.float32)
+
+    # combine with horizontal offsets: d^2 = dx^2 + column distance^2
+    column_sq = column ** 2
+    dist_sq = column_sq.copy()
+    for dx in range(1, cap + 1):
+        offset_sq = dx * dx
+        numpy.minimum(dist_sq[dx:], column_sq[:-dx] + offset_sq, out=dist_sq[dx:])
+        numpy.minimum(dist_sq[:-dx], column_sq[dx:] + offset_sq, out=dist_sq[:-dx])
+
+    return numpy.minimum(numpy.sqrt(dist_sq), max_distance)[1:-1, 1:-1]
+
+# the map scale the IR intensity formula was fitted at, other maps convert their ranges to it
+IR_PIXEL_PER_METER = 150
+
+def ir_step(pixel_per_meter):
+    # IR ray sample spacing in map pixels, never coarser than a pixel at IR_PIXEL_PER_METER
+    return min(1.0, pixel_per_meter / IR_PIXEL_PER_METER)
+
+def ir_intensity(ranges, max_range, pixel_per_meter=IR_PIXEL_PER_METER):
+    # convert ranges in map pixels to Create3 style IR intensities, the same for any map resolution
+    scale = IR_PIXEL_PER_METER / pixel_per_meter
+    return 71.4*((max_range*scale+1)/(numpy.asarray(ranges)*scale+1) - 1)
+def sample_grid(grid, x, y, outside):
+    # vectorized grid[x, y] lookup for pixel coordinate arrays, returns outside for points off the grid
+    x = numpy.asarray(x).astype(numpy.intp)
+    y = numpy.asarray(y).astype(numpy.intp)
+    width, height = grid.shape
+    inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+    return numpy.where(inside, grid[numpy.clip(x, 0, width - 1), numpy.clip(y, 0, height - 1)], outside)
+
+
+# notes are clamped to what the simulator can synthesize, longer notes are cut short
+MAX_NOTE_FREQUENCY = 20000.0 # Hz
+MAX_NOTE_DURATION = 10.0 # seconds
+
+def audio_note(frequency, duration):
+    # (frequency, duration) as bounded floats, ValueError or TypeError for values that are not numbers
+    frequency, duration = float(frequency), float(duration)
+    if not (isfinite(frequency) and isfinite(duration)):
+        raise ValueError(f'note of {frequency} Hz for {duration} s')
+    return min(max(frequency, 0.0), MAX_NOTE_FREQUENCY), min(max(duration, 0.0), MAX_NOTE_DURATION)
+
+def parse_audio_notes(msg):
+    # returns [(frequency in Hz, duration in seconds), ...] from an AudioNoteVector message
+    notes = []
+    for note in msg.get('notes', []):
+        if 'max_runtime' in note:
+            runtime = note['max_runtime']
+            notes.append(audio_note(note.get('frequency', 0), float(runtime.get('sec', 0)) + float(runtime.get('nanosec', 0)) / 1e9))
+        else:
+            # older {note, duration} messages
+            notes.append(audio_note(note.get('note', 0), note.get('duration', 0)))
+    return notes
+
+@functools.lru_cache(maxsize=64)
+def tone_buffer(frequency, duration, sample_rate=44100):
+    # stereo 16 bit sine tone, the right channel is 110 Hz higher and half as loud
+    n_samples = int(round(duration*sample_rate))
+    t = numpy.arange(n_samples) / sample_rate # time in seconds
+    max_sample = 2**(16 - 1) - 1
+    buf = numpy.empty((n_samples, 2), dtype=numpy.int16)
+    buf[:, 0] = numpy.round(max_sample*numpy.sin(2*pi*frequency*t))             # left
+    buf[:, 1] = numpy.round(max_sample*0.5*numpy.sin(2*pi*(frequency + 110)*t)) # right
+    buf.flags.writeable = False # shared by every caller
+    return buf
+
+@functools.lru_cache(maxsize=64)
+def tone_sound(frequency, duration):
+    return pygame.sndarray.make_sound(tone_buffer(frequency, duration))
+
+
+# sprites are rotated in steps of this many degrees
+ROTATION_STEP = 2
+
+# one slot per step for every image that is drawn rotated, dropped with the image
+rotations = weakref.WeakKeyDictionary()
+
+def rotated_image(image, step):
+    # image rotated by step * ROTATION_STEP degrees, shared by every robot using the same image
+    slots = rotations.get(image)
+    if slots is None:
+        slots = rotations[image] = [None] * (360 // ROTATION_STEP)
+    if slots[step] is None:
+        slots[step] = pygame.transform.rotate(image, step * ROTATION_STEP)
+    return slots[step]
+
+
+def led_component(value):
+    # an LED's red, green or blue as an int in 0-255, ValueError for anything else
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value <= 255:
+        raise ValueError(f'LED color component {value!r} is not a number in 0-255')
+    return int(value)
+
+
+@functools.lru_cache(maxsize=128)
+def light_ring_surface(colors):
+    # light ring with one pie slice per (r, g, b) in colors, cached so repeated patterns cost nothing
+    ring_radius = 40
+    ring_radius_extended = 50
+    ring_width = 10
+    light_ring = pygame.Surface((2*ring_radius, 2*ring_radius), pygame.SRCALPHA)
+    light_ring.fill((0,0,0,0))
+    cx, cy = light_ring.get_rect().center
+
+    # loop over each pie slice and draw the color in a polygon
+    for i, color in enumerate(colors):
+        start_angle = radians(i * 60)
+        end_angle = radians((i+1) * 60)
+        pt1 = (cx, cy) # center of the circle
+        pt2 = (cx + ring_radius_extended * cos(start_angle), cy + ring_radius_extended * sin(start_angle))
+        pt3 = (cx + ring_radius_extended * cos(end_angle), cy + ring_radius_extended * sin(end_angle))
+        pygame.draw.polygon(light_ring, color, [pt1, pt2, pt3])
+
+    # now cut a hole in the middle
+    pygame.draw.circle(light_ring, (0,0,0,0), (cx, cy), ring_radius - ring_width)
+
+    # now make a circl mask to make the light ring circular
+    mask = pygame.Surface((2*ring_radius, 2*ring_radius), pygame.SRCALPHA)
+    mask.fill((255,255,255,0))
+    pygame.draw.circle(mask, (0,0,0,255), (cx, cy), ring_radius)
+    light_ring.blit(mask, (0,0), special_flags=pygame.BLEND_RGB_ADD)
+    return light_ring
+
+
+class AudioPlayer:
+    """
+    Plays AudioNoteVector notes for every robot on a single worker thread. Each robot has its own queue,
+    so its notes play in order while different robots can sound at the same time. play() only queues
+    notes, it never blocks the frame loop.
+    """
+
+    def __init__(self):
+        self.queues = {} # robot name -> deque of (frequency, duration)
+        self.channels = {} # robot name -> pygame Channel of the note playing now
+        self.busy_until = {} # robot name -> time.monotonic() when the current note ends
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def play(self, name, notes, append=False):
+        with self.condition:
+            queue = self.queues.setdefault(name, deque())
+            if not append:
+                # replace whatever this robot is playing
+                queue.clear()
+                channel = self.channels.pop(name, None)
+                if channel is not None:
+                    channel.stop()
+                self.busy_until.pop(name, None)
+            queue.extend(notes)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        # the mixer is only started once something is played, on this thread since opening the audio device can be slow
+        try:
+            pygame.mixer.init(44100, -16, 2)
+        except pygame.error as e:
+            print(f'Could not start audio: {e}')
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                due = []
+                for name, queue in self.queues.items():
+                    if queue and now >= self.busy_until.get(name, 0):
+                        frequency, duration = queue.popleft()
+                        self.busy_until[name] = now + duration
+                        due.append((name, frequency, duration, now + duration))
+                if not due:
+                    # sleep until the next note ends, or until more notes are queued
+                    waits = [end - now for name, end in self.busy_until.items() if self.queues.get(name) and end > now]
+                    self.condition.wait(min(waits) if waits else None)
+                    continue
+
+            # synthesizing a tone takes a while, play() does not wait for it
+            for name, frequency, duration, end in due:
+                channel = self.start_note(frequency, duration)
+                with self.condition:
+                    if self.busy_until.get(name) == end:
+                        self.channels[name] = channel
+                    elif channel is not None:
+                        # play() replaced this robot's notes meanwhile
+                        channel.stop()
+
+    @staticmethod
+    def start_note(frequency, duration):
+        # frequency 0 is a rest
+        if frequency <= 0 or duration <= 0:
+            return None
+        try:
+            return tone_sound(frequency, duration).play(loops = 0)
+        except Exception as e:
+            # e.g. no audio device, or a mixer that did not open in 16 bit stereo. The worker keeps playing other notes
+            print(f'Could not play a {frequency} Hz note: {e!r}')
+            return None
+
+
+class FrameProfiler:
+    """
+    Always-on timing of the named stages of each frame (events, physics, ir, publish, render, ...).
+    Every stage keeps a rolling window of its last durations, summarized as percentiles and a histogram
+    over fixed bins. Can also run cProfile over the next N frames and dump the stats to disk.
+    """
+    histogram_bins_ms = (0.01, 0.1, 0.5, 1, 2, 5, 10, 20, 50) # upper bin edges, the last bin is open ended
+
+    def __init__(self, window=600):
+        self.window = window
+        self.samples = {} # stage -> ring buffer of durations in ns
+        self.counts = {} # stage -> number of durations ever recorded
+        self.profile = None
+        self.profile_frames_left = 0
+        self.profile_path = None
+
+    def record(self, stage, start_ns):
+        # record the time since start_ns (from time.perf_counter_ns) for stage, returns the current time
+        now = time.perf_counter_ns()
+        count = self.counts.get(stage, 0)
+        if count < self.window:
+            self.samples.setdefault(stage, []).append(now - start_ns)
+        else:
+            self.samples[stage][count % self.window] = now - start_ns
+        self.counts[stage] = count + 1
+        return now
+
+    def summary(self):
+        # stage -> statistics of the durations in the rolling window, in milliseconds
+        bins = (0,) + self.histogram_bins_ms + (float('inf'),)
+        result = {}
+        for stage, samples in self.samples.items():
+            ms = numpy.asarray(samples) / 1e6
+            result[stage] = {
+                'count': self.counts[stage],
+                'mean_ms': float(ms.mean()),
+                'p50_ms': float(numpy.percentile(ms, 50)),
+                'p95_ms': float(numpy.percentile(ms, 95)),
+                'max_ms': float(ms.max()),
+                'histogram': numpy.histogram(ms, bins=bins)[0].tolist(),
+            }
+        return result
+
+    def start_profile(self, frames, path):
+        # run cProfile over the next frames and write the stats to path (open with pstats or snakeviz)
+        if self.profile is not None:
+            return
+        print(f'Profiling {frames} frames to {path}')
+        self.profile_frames_left = frames
+        self.profile_path = path
+        import cProfile
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def end_frame(self):
+        if self.profile is None:
+            return
+        self.profile_frames_left -= 1
+        if self.profile_frames_left <= 0:
+            self.profile.disable()
+            self.profile.dump_stats(self.profile_path)
+            print(f'Profile written to {self.profile_path}')
+            self.profile = None
+
+
+class Fleet:
+    """
+    Struct-of-arrays state for every robot in a simulator. Pose, velocity, collision and IR state live
+    in NumPy arrays indexed by Create3.index, so the unicycle update, collision checks and IR ray casting
+    run once for the whole fleet instead of once per sprite.
+    """
+
+    def __init__(self, ros_instance):
+        self.ros = ros_instance
+        self.robots = [] # Create3 sprites in index order
+        self.x = numpy.zeros(0) # in meters
+        self.y = numpy.zeros(0) # in meters
+        self.theta = numpy.zeros(0) # in radians
+        self.v = numpy.zeros(0) # linear velocity in m/s
+        self.theta_dot = numpy.zeros(0) # in radians per second
+        self.radius = numpy.zeros(0) # in pixels
+        self.collision = numpy.zeros(0, dtype=bool)
+        self.collisions = numpy.zeros(0, dtype=int) # number of times each robot ran into a wall
+        self.ir = numpy.zeros((0, len(Create3.ir_points)))
+        # last IR rays in pixels, kept around for drawing
+        self.ir_origins = numpy.zeros((0, len(Create3.ir_points), 2))
+        self.ir_directions = numpy.zeros((0, len(Create3.ir_points), 2))
+        self.ir_ranges = numpy.zeros((0, len(Create3.ir_points)))
+
+    def __len__(self):
+        return len(self.robots)
+
+    def add(self, robot, pose=(0, 0, 0)):
+        # register a robot and return its index into the state arrays
+        x, y, theta = pose
+        self.robots.append(robot)
+        self.x = numpy.append(self.x, x)
+        self.y = numpy.append(self.y, y)
+        self.theta = numpy.append(self.theta, theta)
+        self.v = numpy.append(self.v, 0.0)
+        self.theta_dot = numpy.append(self.theta_dot, 0.0)
+        self.radius = numpy.append(self.radius, robot.radius)
+        self.collision = numpy.append(self.collision, False)
+        self.collisions = numpy.append(self.collisions, 0)
+        self.ir = numpy.vstack((self.ir, numpy.zeros((1, self.ir.shape[1]))))
+        self.ir_origins = numpy.concatenate((self.ir_origins, numpy.zeros((1,) + self.ir_origins.shape[1:])))
+        self.ir_directions = numpy.concatenate((self.ir_directions, numpy.zeros((1,) + self.ir_directions.shape[1:])))
+        self.ir_ranges = numpy.vstack((self.ir_ranges, numpy.zeros((1, self.ir_ranges.shape[1]))))
+        return len(self.robots) - 1
+
+    def update(self, dt):
+        if not self.robots:
+            return
+        start = time.perf_counter_ns()
+        # Update velocities from the cmd_vel topics
+        for i, robot in enumerate(self.robots):
+            self.v[i], self.theta_dot[i] = robot.read_cmd_vel()
+
+        # Calculate new positions in METERS with TIME_STEP
+        new_x = self.x + self.v * numpy.cos(self.theta) * dt
+        new_y = self.y + self.v * numpy.sin(self.theta) * dt
+        self.theta += self.theta_dot * dt # robots always rotate
+
+        # robots are circles, so they hit a wall when their centre is closer than their radius
+        px, py = self.ros.to_pixels(new_x, new_y)
+        collision = sample_grid(self.ros.wall_distance, px, py, 0.0) < self.radius
+        self.collisions += collision & ~self.collision # only count the first step of each contact
+        self.collision = collision
+        self.x = numpy.where(self.collision, self.x, new_x)
+        self.y = numpy.where(self.collision, self.y, new_y)
+        self.ros.profiler.record('physics', start)
+        self.sense()
+
+    def sense(self):
+        # generate IR measurements for every robot at once
+        start = time.perf_counter_ns()
+        px, py = self.ros.to_pixels(self.x, self.y)
+        max_pixel_range = Create3.IR_RANGE * self.ros.pixel_per_meter
+        self.ir_origins, self.ir_directions = ir_rays(px, py, self.theta, Create3.ir_angles, self.radius[:, None, None])
+        self.ir_ranges = cast_rays(self.ros.wall_map, self.ir_origins, self.ir_directions, max_pixel_range, ir_step(self.ros.pixel_per_meter))
+        self.ir = ir_intensity(self.ir_ranges, max_pixel_range, self.ros.pixel_per_meter)
+        self.ros.profiler.record('ir', start)
+
+def fleet_state(name, doc):
+    # property that reads and writes this robot's entry in the fleet array called name
+    def fget(self):
+        return getattr(self.ros.fleet, name)[self.index]
+    def fset(self, value):
+        getattr(self.ros.fleet, name)[self.index] = value
+    return property(fget, fset, doc=doc)
+
 
 class Create3(pygame.sprite.Sprite):
     """
@@ -18,26 +426,40 @@ This module simulates a Create3 robot using Pygame and integrates with ROS via W
 Classes:
     Create3(pygame.sprite.Sprite): Represents the Create3 robot with methods to update its state, check for collisions, and publish odometry.
     Topic: Represents a ROS topic with methods to publish and subscribe to messages.
-    WebSocketProtocol(WebSocketServerProtocol): Handles WebSocket connections and message broadcasting for ROS topics.
     RosSimulator: Manages the Pygame simulation environment, including robot creation, background setup, and the main simulation loop.
+    The WebSocket server lives in twisted_server.py (default) and asyncio_server.py, both built on rosbridge.RosbridgeProtocol.
 Functions:
-    main(): Initializes the ROS simulator, sets up the WebSocket server, and starts the Pygame simulation loop integrated with the Twisted reactor.
+    main(): Initializes the ROS simulator and runs it with the WebSocket server of the chosen engine.
 Usage:
     Run this module directly to start the Create3 robot simulation with ROS integration.
 """
 
-    def __init__(self, screen, ros_instance, name='juliet'):
+    ir_points = [-65.3,-34,-14.25,3,20,38,65.3] # in degrees, from create3 technical specs
+    ir_angles = numpy.radians(ir_points)
+    IR_RANGE = 0.1 # in meters
+
+    # Robot state, stored in the simulator's Fleet arrays
+    x = fleet_state('x', 'x position in meters')
+    y = fleet_state('y', 'y position in meters')
+    theta = fleet_state('theta', 'heading in radians')
+    v = fleet_state('v', 'linear velocity in m/s')
+    theta_dot = fleet_state('theta_dot', 'angular velocity in radians per second')
+
+    # default sensor publish rates in Hz, matching the real Create3
+    default_publish_rates = {'odom': 20, 'imu': 100, 'ir_intensity': 62}
+
+    def __init__(self, screen, ros_instance, name='juliet', pose=(0, 0, 0), publish_rates=None):
         super().__init__()
         
         print(f'Creating robot {name}')
-        # check if ./create3.png exists
-        load_image = os.path.exists('./create3.png')
-        load_image = 1
-
-        if load_image:
-            self.image = pygame.image.load('./create3.png').convert_alpha()
-            self.image = pygame.transform.rotate(self.image, -90)
-            self.image = pygame.transform.smoothscale(self.image, (self.image.get_width() // 5, self.image.get_height() // 5))
+        self.name = name
+        self.ros = ros_instance
+        # create3.png next to this module, prepared once and shared by every robot (see sim_assets.py)
+        # convert_alpha needs a video mode, which headless simulators never set
+        image = sim_assets.robot_image(converted=pygame.display.get_surface() is not None)
+
+        if image is not None:
+            self.image = image
         else:
             # make a circle
             r = 30
@@ -46,279 +468,261 @@ Usage:
             # draw a smaller circle for the center
             pygame.draw.circle(self.image, (150,150,150), (r, r), r-5)
 
-        self.radius = self.image.get_width() // 2 -10# radius of robot in pixels
-        self.radius_points = []
-        for i in range(0, 360, 30):
-            self.radius_points.append((self.radius * cos(i), self.radius * sin(i)))
-        self.ir_points = [-65.3,-34,-14.25,3,20,38,65.3] # in degrees, from create3 technical specs
-        self.IR_RANGE = 0.1 # in meters
-
         self.og_image = self.image
+        self.scale_to_map()
         self.rect = self.image.get_rect(center=screen.get_rect().center)
         self.robot_width = self.rect.width
         self.screen = screen
 
         # Robot state
-        self.pixel_per_meter = 150
-        self.theta = 0 # in radians
-        self.theta_dot = 0 # in radians per second
-        self.x, self.y = (0,0)
-        self.rect.center = self.get_pixel_position()
-        self.v = 0                 # linear velocity in m/s
-        self.ir_measurements = [0]*len(self.ir_points)
-
-        
-        # timing variables
-        self.fps = 60
-        self.dt = 1 / self.fps
+        self.index = ros_instance.fleet.add(self, pose)
+        self.rect.center = self.ros.to_screen(*self.get_pixel_position())
 
         # led lights (list of 6 red, green, blue values as dict keys)
         self.light_vector = []
         #self.light_vector = [{'red':random.randint(0,255), 'green':random.randint(0,255), 'blue':random.randint(0,255)} for i in range(6)]
-        self.draw_light_ring()
+        self.light_colors = () # (r, g, b) per led, the light ring cache key
+        self.light_ring_colors = None # colors of self.light_ring
 
         # ROS topics
-        self.ros = ros_instance
         self.cmd_vel_topic = Topic(ros_instance, f'/{name}/cmd_vel', 'geometry_msgs/Twist')
         self.odom_topic = Topic(ros_instance, f'/{name}/odom', 'nav_msgs/Odometry')
         self.imu_topic = Topic(ros_instance, f'/{name}/imu', 'sensor_msgs/Imu')
         self.ir_topic = Topic(ros_instance, f'/{name}/ir_intensity', 'irobot_create_msgs/IrIntensityVector')
         self.light_topic = Topic(ros_instance, f'/{name}/cmd_lightring', 'irobot_create_msgs/LightVector')
         self.audio_topic = Topic(ros_instance, f'/{name}/cmd_audio', 'irobot_create_msgs/AudioNoteVector')
-        self.audio_topic.msg = None
 
         # callback to set lights
         self.light_topic.subscribe(self.set_lights)
-
-    def update(self):
-        # Update velocities from cmd_vel topic
-
-        if self.cmd_vel_topic.msg and not self.cmd_vel_topic.has_timed_out():
-            # we have a message and it is not timed out
-            self.v = self.cmd_vel_topic.msg['linear']['x']
-            self.theta_dot = self.cmd_vel_topic.msg['angular']['z']
-        
-        else:
-            # no message or timed out
-            self.v = 0
-            self.theta_dot = 0
-
-        # Calculate new position in METERS with TIME_STEP
-        new_x = self.x + self.v * cos(self.theta) * self.dt 
-        new_y = self.y + self.v * sin(self.theta) * self.dt
-        self.theta = self.theta + self.theta_dot * self.dt # robot always rotates
-
-        if not self.check_collision(new_x, new_y):
-            # no collision!
-            self.collision = False
-            self.x, self.y = new_x, new_y
+        # callback to queue notes on the simulator's audio worker
+        self.audio_topic.subscribe(self.play_notes)
+
+        # pre-encoded sensor messages, only the changing numbers are filled in on publish
+        self.odom_template = ros_messages.odom_template(self.odom_topic.topic_name)
+        self.imu_template = ros_messages.imu_template(self.imu_topic.topic_name)
+        self.ir_template = ros_messages.ir_template(self.ir_topic.topic_name)
+
+        # sensor topics are published on their own schedule in sim time
+        self.publishers = {'odom': self.publish_odom, 'imu': self.publish_imu, 'ir_intensity': self.publish_ir}
+        self.publish_periods = {}
+        self.next_publish = {}
+        for topic_name, rate in {**self.default_publish_rates, **(publish_rates or {})}.items():
+            self.set_publish_rate(topic_name, rate)
+
+    def scale_to_map(self):
+        # sizes in pixels of the simulator's map, again whenever it loads another map
+        self.radius = (self.og_image.get_width() // 2 -10) / self.ros.display_scale # radius of robot in map pixels
+        self.pixel_per_meter = self.ros.pixel_per_meter
+
+    @property
+    def collision(self):
+        return bool(self.ros.fleet.collision[self.index])
+
+    @property
+    def ir_measurements(self):
+        return self.ros.fleet.ir[self.index].tolist()
+
+    @property
+    def ir_rays(self):
+        # (origins, directions, ranges) of the last IR measurement
+        fleet = self.ros.fleet
+        return fleet.ir_origins[self.index], fleet.ir_directions[self.index], fleet.ir_ranges[self.index]
+
+    def read_cmd_vel(self):
+        # returns the commanded (v, theta_dot) from the cmd_vel topic
+        msg = self.cmd_vel_topic.msg
+        if msg and not self.cmd_vel_topic.has_timed_out():
+            # we have a message and it is not timed out, missing fields are 0 as in ROS
+            try:
+                v, theta_dot = float(msg.get('linear', {}).get('x', 0)), float(msg.get('angular', {}).get('z', 0))
+                if not (isfinite(v) and isfinite(theta_dot)):
+                    # NaN would stick in the pose and in every odom message
+                    raise ValueError(f'velocity {v} m/s, {theta_dot} rad/s')
+                return v, theta_dot
+            except (AttributeError, TypeError, ValueError) as e:
+                # reported once, then treated as no command
+                self.ros.inbound_error(f'{self.cmd_vel_topic.topic_name} message {msg!r}'[:200], e)
+                self.cmd_vel_topic.msg = None
+        # no message or timed out
+        return 0, 0
+
+    def play_notes(self, msg):
+        '''
+        "{append: false, notes: [{frequency: 392, max_runtime: {sec: 0, nanosec: 177500000}}, {frequency: 523, max_runtime: {sec: 0, nanosec: 355000000}}]}"
+        '''
+        # headless simulators stay silent
+        if not self.ros.headless:
+            self.ros.audio.play(self.name, parse_audio_notes(msg), msg.get('append', False))
+
+    def set_publish_rate(self, topic_name, rate):
+        # publish topic_name ('odom', 'imu' or 'ir_intensity') at rate Hz of sim time, 0 or None stops it
+        if topic_name not in self.publishers:
+            raise ValueError(f'{topic_name} is not a sensor topic, expected one of {list(self.publishers)}')
+        if rate:
+            self.publish_periods[topic_name] = 1 / rate
+            self.next_publish[topic_name] = self.ros.sim_time
         else:
-            self.collision = True
-
-        # generate IR measurements
-        self.ir_measurements = self.measure_IR(self.x, self.y)
-        self.rect.center = self.get_pixel_position()
-        self.image = self.og_image
-
-        # play audio if message comes through
-        if self.audio_topic.msg is not None:
-            threading.Thread(target=self.play_audio, args=(self.audio_topic.msg['notes'][0]['note'],self.audio_topic.msg['notes'][0]['duration']), daemon=True).start()
-            self.audio_topic.msg = None
-        
-        # Blit the light ring that has already been created
-        self.screen.blit(self.light_ring, self.light_ring_rect)
-        self.image = pygame.transform.rotate(self.image, degrees(self.theta))
-        self.rect = self.image.get_rect(center=self.rect.center)
-
-        # Publish sensor messages
-        self.publish_odom()
-        self.publish_imu()
-        self.publish_ir()
-
-    def draw_light_ring(self):
-        # make a new surface to draw the light ring
-        ring_radius = 40
-        ring_radius_extended = 50
-        ring_width = 10
-        self.light_ring = pygame.Surface((2*ring_radius, 2*ring_radius), pygame.SRCALPHA)
-        self.light_ring.fill((0,0,0,0))
-        self.light_ring_rect = self.light_ring.get_rect()
-        cx, cy = self.light_ring_rect.center
-
-
-
-        # loop over each pie slice and draw the color in a polygon
-        for i, color in enumerate(self.light_vector):
-            start_angle = radians(i * 60)
-            end_angle = radians((i+1) * 60)
-            pt1 = (cx, cy) # center of the circle
-            pt2 = (cx + ring_radius_extended * cos(start_angle), cy + ring_radius_extended * sin(start_angle))
-            pt3 = (cx + ring_radius_extended * cos(end_angle), cy + ring_radius_extended * sin(end_angle))
-            pygame.draw.polygon(self.light_ring, (color['red'], color['green'], color['blue']), [pt1, pt2, pt3])
-
-        # now cut a hole in the middle
-        pygame.draw.circle(self.light_ring, (0,0,0,0), (cx, cy), ring_radius - ring_width)
-
-        # now make a circl mask to make the light ring circular
-        mask = pygame.Surface((2*ring_radius, 2*ring_radius), pygame.SRCALPHA)
-        mask.fill((255,255,255,0))
-        pygame.draw.circle(mask, (0,0,0,255), (cx, cy), ring_radius)
-        self.light_ring.blit(mask, (0,0), special_flags=pygame.BLEND_RGB_ADD)
-
-
-        # blit the light ring to the screen
-        self.light_ring_rect.centerx = 50
-        self.light_ring_rect.centery = 100
+            self.publish_periods.pop(topic_name, None)
+            self.next_publish.pop(topic_name, None)
+
+    def publish_sensors(self, sim_time):
+        # Publish the sensor messages that are due, skipped cycles never build a message
+        for topic_name, due in self.next_publish.items():
+            if sim_time + 1e-9 < due: # tolerate float rounding in the accumulated sim time
+                continue
+            period = self.publish_periods[topic_name]
+            # stay on the fixed schedule, unless we fell more than a whole period behind
+            due += period
+            self.next_publish[topic_name] = due if due > sim_time else sim_time + period
+            self.publishers[topic_name]()
+
+    def render(self, surface):
+        # draw the IR rays and light ring, and pick the rotated sprite image for the group draw
+        # returns the rects that were drawn on
+        drawn = self.draw_IR(surface)
+        # Blit the light ring around the robot, it is only looked up again when the colors change
+        if self.light_ring_colors != self.light_colors:
+            self.light_ring_colors = self.light_colors
+            self.light_ring = light_ring_surface(self.light_colors)
+        center = self.ros.to_screen(*self.get_pixel_position())
+        drawn.append(surface.blit(self.light_ring, self.light_ring.get_rect(center=center)))
+        self.image = rotated_image(self.og_image, round(degrees(self.theta) / ROTATION_STEP) % (360 // ROTATION_STEP))
+        self.rect = self.image.get_rect(center=center)
+        return drawn
 
     def set_lights(self,msg):
         '''
         "{override_system: true, leds: [{red: 255, green: 0, blue: 0}, {red: 0, green: 255, blue: 0}, {red: 0, green: 0, blue: 255}, {red: 255, green: 255, blue: 0}, {red: 255, green: 0, blue: 255}, {red: 0, green: 255, blue: 255}]}"
         '''
-        led_msg = msg.get('leds', None)
-        # get the led msg
-        if not led_msg:
-            # no message, LIGHTS OFF
-            self.light_vector = []
-            return
-        else:
-            # set the light vector
-            self.light_vector = led_msg
-        
-        # draw the light ring
-        self.draw_light_ring()
+        # get the led msg, no message means LIGHTS OFF
+        light_vector = msg.get('leds', None) or []
+        # only remember the colors here, the ring is drawn (or found in the cache) on the frame loop.
+        # Checked first, so a bad message is reported as an inbound error and the ring stays as it was
+        light_colors = tuple(tuple(led_component(color[key]) for key in ('red', 'green', 'blue')) for color in light_vector)
+        self.light_vector, self.light_colors = light_vector, light_colors
   
     def check_collision(self,x_m, y_m):
         x, y = self.get_pixel_position(x_m, y_m) # convert meters to pixels
         
-        # look at pixels around the robot radius and check if any of them are walls
-        for point in self.radius_points:
-            if self.check_wall((x + point[0], y + point[1])):
-                return True
-        return False
+        # the robot is a circle, so it hits a wall when its centre is closer than its radius
+        return self.ros.wall_distance_at((x, y)) < self.radius
 
     def get_pixel_position(self, x = None, y = None):
         # if no x, y given, use current self.x, self.y
         if None in (x, y):
             x, y = self.x, self.y
         # take an x,y position in meters and set the pixel position
-        pixel_center = self.screen.get_rect().center
-        return (x * self.pixel_per_meter + pixel_center[0], pixel_center[1] - y * self.pixel_per_meter)
+        return self.ros.to_pixels(x, y)
 
     def check_wall(self, point):
-        #checks pixel value at point and returns True if it is a wall
-        point = (int(point[0]), int(point[1]))
-        rgb_val = self.ros.background.get_at(point)
-        return rgb_val[0] < 60  # Check for a "wall"
+        # looks the point up in the occupancy grid and returns True if it is a wall
+        return self.ros.is_wall(point)
 
     def measure_IR(self,x_m,y_m):
-        """Simulates LiDAR and returns range measurements."""
-        # cx, cy is the FRONT of the robot
-        px, py = self.get_pixel_position() # current position in pixels
-
-        
-
-        ranges = [] # range in pixels
-
+        """Simulates the IR sensors and returns intensity measurements."""
+        px, py = self.get_pixel_position(x_m, y_m) # position in pixels
         max_pixel_range = self.IR_RANGE * self.pixel_per_meter
 
-        for angle in self.ir_points:
-            
-            # get front of robot in pixels
-            fpx = self.radius * cos(self.theta+radians(angle)) + px
-            fpy = self.radius * sin(-self.theta-radians(angle)) + py
-
-            ray_dx = cos(self.theta + radians(angle))
-            ray_dy = sin(-self.theta - radians(angle))
-            distance = 0
-
-            while distance < max_pixel_range:
-                distance += 1 # in pixels (resolution distance)
-                x = int(fpx + ray_dx * distance) # pixel x
-                y = int(fpy + ray_dy * distance) # pixel y
-
-                # Check if the ray collides with a wall or obstacle
-                if self.check_wall((x,y)):
-                    break
-    
-            # Store the distance ( for that angle)
-            ranges.append(distance)
-            # Draw the ray
-            endpoint = (fpx + ray_dx * distance, fpy + ray_dy * distance)
-            pygame.draw.line(self.screen, self.ros.colors.get('red'), (fpx, fpy), endpoint, 1)
-
-            
-        #return [ r/max_pixel_range * 255 for r in ranges]
-        #print(ranges)
-        #print([ (max_pixel_range+1)/(r+1) - 1 for r in ranges])
-        return [ 71.4*((max_pixel_range+1)/(r+1) - 1) for r in ranges]
+        # rays start at the FRONT of the robot, one per sensor
+        origins, directions = ir_rays(px, py, self.theta, self.ir_angles, self.radius)
+        ranges = cast_rays(self.ros.wall_map, origins, directions, max_pixel_range, ir_step(self.pixel_per_meter)) # range in pixels
+        return ir_intensity(ranges, max_pixel_range, self.pixel_per_meter).tolist()
+
+    def draw_IR(self, surface):
+        # draw the rays from the last measurement, returns the rects that were drawn on
+        origins, directions, ranges = self.ir_rays
+        endpoints = origins + directions * ranges[..., None]
+        # map pixels to window pixels
+        offset = (self.ros.camera.left, self.ros.camera.top)
+        starts = (origins * self.ros.display_scale - offset).tolist()
+        ends = (endpoints * self.ros.display_scale - offset).tolist()
+        return [pygame.draw.line(surface, self.ros.colors.get('red'), start, end, 1) for start, end in zip(starts, ends)]
 
     def publish_odom(self):
-        msg = {
-                'pose': {
-                    'pose': {'position': {'x': self.x, 'y': self.y, 'z': 0}, 'orientation': {'x': 0, 'y': 0, 'z': sin(self.theta/2), 'w': cos(self.theta/2)}},
-                    'covariance': numpy.zeros((36,1)).tolist()
-                },
-                'twist': {
-                    'twist': {'linear': {'x': self.v, 'y': 0, 'z': 0},'angular': {'x': 0, 'y': 0, 'z': self.theta_dot}},
-                    'covariance': numpy.zeros((36,1)).tolist()
-                }
-            }
-        
-        self.publish_message('odom', msg)
+        template = self.odom_template
+        if self.ros.has_subscribers(template.topic):
+            self.ros.broadcast_template(template, self.x, self.y, sin(self.theta/2), cos(self.theta/2), self.v, self.theta_dot)
     
     def publish_imu(self):
-        # https://iroboteducation.github.io/create3_docs/api/odometry/
-        msg = {
-                'orientation': {'x': 0, 'y': 0, 'z': sin(self.theta/2), 'w': cos(self.theta/2)
-                },
-                'angular_velocity': {'x': 0, 'y': 0, 'z': self.theta_dot
-                },
-                'linear_acceleration': {'x': 0, 'y': 0, 'z': 0
-                },
-            }
-        self.publish_message('imu', msg)
+        template = self.imu_template
+        if self.ros.has_subscribers(template.topic):
+            self.ros.broadcast_template(template, sin(self.theta/2), cos(self.theta/2), self.theta_dot)
 
     def publish_ir(self):
-        frame_names = [
-            'side_left', 'left', 'front_left', 'front_center_left', 'front_center_right', 'front_right', 'right'
-        ]
-        frame_names.reverse()
-        readings = [ {'header': {'frame_id': f'ir_intensity_{frame_names[i]}' }, 'value': self.ir_measurements[i]} for i in range(len(self.ir_measurements))]
-
-        msg = { 'readings': readings }
-
-        self.publish_message('ir_intensity', msg)
+        template = self.ir_template
+        if self.ros.has_subscribers(template.topic):
+            self.ros.broadcast_template(template, *self.ros.fleet.ir[self.index])
         
     def publish_message(self, topic_name, message):
-        if self.ros.broadcast_payload:
+        topic = f'/{self.name}/{topic_name}'
+        if self.ros.has_subscribers(topic):
             self.ros.broadcast_payload({
                     'op': 'publish',
-                    'topic': f'/{self.ros.robot_name}/{topic_name}',
+                    'topic': topic,
                     'msg': message
                 })
-    
-    def play_audio(self, frequency, duration):
-        print("here")
-        sample_rate = 44100
-        n_samples = int(round(duration*sample_rate))
 
-        frequency_l = frequency
-        frequency_r = frequency + 110
-
-        #setup our numpy array to handle 16 bit ints, which is what we set our mixer to expect with "bits" up above
-        buf = numpy.zeros((n_samples, 2), dtype = numpy.int16)
-        max_sample = 2**(16 - 1) - 1
-
-        for s in range(n_samples):
-            t = float(s)/sample_rate    # time in seconds
-
-            #grab the x-coordinate of the sine wave at a given time, while constraining the sample to what our mixer is set to with "bits"
-            buf[s][0] = int(round(max_sample*sin(2*pi*frequency_l*t)))        # left
-            buf[s][1] = int(round(max_sample*0.5*sin(2*pi*frequency_r*t)))    # right
+class TopicStats:
+    """
+    Arrival statistics of one topic. Keeps the arrival times (time.monotonic_ns, or the simulator's
+    clock_ns) of the last `capacity` messages in a fixed ring buffer, which gives exact rates, gaps and
+    jitter over that window, and the time since the last message for timeouts.
+    """
+    __slots__ = ('capacity', 'times', 'count', 'first_ns', 'last_ns')
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.times = [0] * capacity
+        self.count = 0 # messages ever recorded
+        self.first_ns = None
+        self.last_ns = None
+
+    def record(self, now_ns):
+        self.times[self.count % self.capacity] = now_ns
+        self.count += 1
+        if self.first_ns is None:
+            self.first_ns = now_ns
+        self.last_ns = now_ns
+
+    def window(self):
+        # arrival times in the ring buffer, oldest first
+        if self.count <= self.capacity:
+            return self.times[:self.count]
+        split = self.count % self.capacity
+        return self.times[split:] + self.times[:split]
+
+    def gaps(self):
+        # time between consecutive messages in the window, in ns
+        times = self.window()
+        return [b - a for a, b in zip(times, times[1:])]
+
+    def rate(self):
+        # messages per second over the window, 0 until there are two messages
+        messages = min(self.count, self.capacity)
+        if messages < 2:
+            return 0.0
+        oldest = self.times[self.count % self.capacity] if self.count > self.capacity else self.times[0]
+        span = self.last_ns - oldest
+        return (messages - 1) * 1e9 / span if span > 0 else 0.0
+
+    def age(self, now_ns):
+        # seconds since the last message, None if there never was one
+        return None if self.last_ns is None else (now_ns - self.last_ns) / 1e9
+
+    def summary(self, now_ns):
+        gaps = self.gaps()
+        mean = sum(gaps) / len(gaps) if gaps else 0.0
+        jitter = (sum((gap - mean) ** 2 for gap in gaps) / len(gaps)) ** 0.5 if gaps else 0.0
+        age = self.age(now_ns)
+        return {
+            'count': self.count,
+            'rate_hz': self.rate(),
+            'mean_gap_ms': mean / 1e6,
+            'jitter_ms': jitter / 1e6,
+            'max_gap_ms': max(gaps, default=0) / 1e6,
+            'age_s': age,
+        }
 
-        sound = pygame.sndarray.make_sound(buf)
-        #play once, zero repeats
-        sound.play(loops = 0)
 
 class Topic:
     def __new__(cls, ros_instance, topic_name, message_type=''):
@@ -338,98 +742,141 @@ class Topic:
         # add the topic to the ros instance
         self.ros.add_topic(self)
         self.callbacks = []
-        self.msg = None
-        self.timeout = 1000 * timeout # in milliseconds
-        self.clock = pygame.time.Clock()
-        self.clock.tick()
+        self._msg = None
+        self.raw = None # latest JSON frame from publish_raw, decoded when msg is read
+        self.timeout_ns = int(timeout * 1e9)
+        self.stats = TopicStats()
         self.max_message_rate = 20 # in Hz
-        self.avg_message_rate = 0
-        self.msg_count = 0
+        self.rate_too_high = False
+
+    @property
+    def msg(self):
+        # the latest message, a frame from publish_raw is only decoded here
+        if self.raw is not None:
+            raw, self.raw = self.raw, None
+            try:
+                self._msg = ros_messages.loads(raw).get('msg')
+            except Exception as e:
+                self.ros.inbound_error(f'{self.topic_name} message', e)
+                self._msg = None
+        return self._msg
+
+    @msg.setter
+    def msg(self, message):
+        self._msg = message
+        self.raw = None
 
     def publish(self, message):
         self.msg = message
-        self.msg_count += 1
+        self.arrived()
 
         #print(f"Messsage published to {self.topic_name}: {message}")
 
-        # update the time
-        self.clock.tick()
-        # run all callbacks
-        [callback(message) for callback in self.callbacks]
-
-        # check to see if the message rate is too high
-        delta_t = self.clock.get_time()
-        if self.msg_count > 10:
-            msg_rate = 1000 / delta_t
-        else :
-            msg_rate = 0
-            self.first_message = False
-
-        self.avg_message_rate = 0.9 * self.avg_message_rate + 0.1* msg_rate
-
-       #print(f"Message rate for {self.topic_name}: {self.avg_message_rate:.2f} Hz")
-
-        if self.avg_message_rate > self.max_message_rate:
-            print(f"Message rate too high for {self.topic_name}: {self.avg_message_rate:.2f} Hz")
-            #self.ros.set_alert(f"Message rate too high for {self.topic_name}: {self.avg_message_rate:.2f} Hz")
+        # callbacks run on the frame loop, never inside network I/O
+        for callback in self.callbacks:
+            self.ros.call_soon(callback, message)
+
+    def publish_raw(self, payload):
+        # fast path for topics without callbacks (cmd_vel): keep the rosbridge JSON frame, it is only decoded
+        # if msg is read before the next one arrives, so a client publishing faster than the physics rate costs no decoding
+        self.raw = payload
+        self.arrived()
+
+    def arrived(self):
+        # a message arrived: update the statistics and warn about too high rates
+        self.stats.record(self.ros.clock_ns())
+        # check to see if the message rate is too high, only warn when it goes over the limit
+        if self.stats.count > 10:
+            rate = self.stats.rate()
+            if rate > self.max_message_rate and not self.rate_too_high:
+                print(f"Message rate too high for {self.topic_name}: {rate:.2f} Hz")
+                #self.ros.set_alert(f"Message rate too high for {self.topic_name}: {rate:.2f} Hz")
+            self.rate_too_high = rate > self.max_message_rate
 
     def has_timed_out(self):
-        # returns True if the topic has timed out
-        return self.clock.get_time() > self.timeout
+        # returns True if no message arrived for longer than the timeout
+        return self.stats.last_ns is None or self.ros.clock_ns() - self.stats.last_ns > self.timeout_ns
 
     def subscribe(self, callback):
         # add the callback to the topic
         self.callbacks.append(callback)
 
-class WebSocketProtocol(WebSocketServerProtocol):
-    def __init__(self, ros_instance):
-        super().__init__()
-        self.ros = ros_instance
-
-        self.robot_name = ros_instance.robot_name
-
-    # if we get a connection, set the ros instance to connected
-    def onConnect(self, request):
-        self.ros.is_connected = True
-        # clear alert message if connected
-        self.ros.set_alert('')
-        print(f'CONNECTED to {request.peer}')
-        # add the broadcast payload to the ros instance
-        self.ros.broadcast_payload = lambda msg: self.broadcast_message(msg)
-
-    def broadcast_message(self, payload):
-        try:
-            #print(f'Broadcasting: {payload}')
-            self.sendMessage(json.dumps(payload).encode('utf8'))
-        except:
-            self.ros.is_connected = False
-            print('No Websocket Connection!' , end='\r') 
-            self.ros.set_alert('Not Connected')    
-
-    def onMessage(self, payload, isBinary):
-        if not isBinary:
-            try:
-                message = json.loads(payload.decode('utf8'))
-                # get the topic
-                t_name = message.get('topic', '')
-                if t_name in self.ros.topic_dict:
-                    t = self.ros.topic_dict[t_name]
-                    t.publish(message.get('msg', None))
-            except:
-                pass
-
 class RosSimulator:
-    def __init__(self, robot_name, host = None, port = None):
-        pygame.mixer.pre_init(44100, -16, 2)
-        pygame.init()
+    def __init__(self, robot_name, host = None, port = None, headless = False, real_time_factor = 1.0, start_poses = None,
+                 physics_rate = 200, render_rate = 60, publish_rates = None, size = (1000, 1000), map_path = None):
+        '''
+        robot_name: name of the robot, or a list of names to simulate a fleet (each gets its own /{name}/... topics)
+        start_poses: optional dict of robot name -> (x, y, theta) in meters/radians, defaults to a grid around the origin,
+            or with a map around its middle, moved out of the walls
+        headless: run without a window; nothing is drawn or flipped, but all topics are still served
+        real_time_factor: simulated seconds per wall-clock second (1, 10, ...). None or 0 runs as fast as possible
+        physics_rate: fixed rate in Hz at which physics and sensors advance, independent of rendering
+        render_rate: frames per second drawn to the window (frames are skipped when physics falls behind)
+        publish_rates: optional dict of sensor topic ('odom', 'imu', 'ir_intensity') -> rate in Hz for every robot,
+            see Create3.set_publish_rate to change a single robot
+        size: (width, height) of the window in pixels, and of the default map
+        map_path: optional ROS map_server map (YAML, or a PGM/PNG image with map_server's default resolution) to
+            load instead of the default arena, it can be much larger than the window
+        '''
+        self.headless = headless
+        if headless:
+            # make sure SDL never tries to open a window (e.g. on display-less CI boxes)
+            os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+        started = time.perf_counter()
+        self.startup_ms = {} # stage -> milliseconds the constructor spent on it, printed by main()
+        # only what every simulator needs, the mixer starts with the first note (see AudioPlayer)
+        if not headless:
+            pygame.display.init()
+        pygame.font.init()
         self.version = '1.01'
         self.alert_msg = 'Not Connected'
-        self.screen = pygame.display.set_mode((1000, 1000))
+        if headless:
+            # plain surface used as the map canvas, never shown
+            self.screen = pygame.Surface(size)
+        else:
+            self.screen = pygame.display.set_mode(size)
         self.clock = pygame.time.Clock()
+
+        # fixed step timing: wall clock time is accumulated and spent in physics_dt sized steps
+        self.physics_dt = 1 / physics_rate
+        self.render_rate = render_rate
+        self.sim_time = 0.0 # simulated seconds
+        self.step_count = 0
+        self.accumulator = 0.0 # simulated seconds not yet stepped
+        self.last_tick = None
+        self.max_frame_time = 0.25 # wall clock seconds, longer stalls are not caught up
+        self.fast_steps = max(1, round(physics_rate / render_rate)) # steps per loop when running as fast as possible
+        self.skipped_frames = 0
+        self.max_skipped_frames = 5
+
+        # rendering state: rects drawn last frame are restored from the background on the next one
+        self.full_redraw = True
+        self.drawn_rects = []
+        self.font = None if headless else pygame.font.Font(None, 24) # headless simulators never draw text
+        self.text_cache = {} # (text, color) -> rendered surface
+        self.fps_text = ''
+        self.fps_updated = 0
+
+        # per stage frame timings, shown with F3 and published on /sim/diagnostics
+        self.profiler = FrameProfiler()
+        self.show_profiler = False
+        self.profiler_text = []
+        self.diagnostics_period = 1.0 # in seconds
+        self.diagnostics_published = 0
+        self.set_real_time_factor(real_time_factor)
         self.running = True
-        self.robots = pygame.sprite.Group()
+        self.robots = pygame.sprite.RenderUpdates() # draw() returns the rects it touched
         self.is_connected = False
         self.topic_dict ={}  # dictionary with topic name as key and topic object as value
+        self.clock_ns = self.topic_clock_ns # arrival clock for topic statistics and timeouts, a replay substitutes its recorded times
+        self._paused = False
+        self.rebase_clock(time.monotonic_ns())
+        self.wall_distance_range = 0.43 # in meters, wall distances are exact up to this value (must exceed the robot radius)
+        self.pixel_per_meter = 150 # of the map, physics and sensing run on its pixels
+        self.display_pixel_per_meter = 150 # of the window, the scale the robot sprites are drawn at
+        self.fleet = Fleet(self)
+        self.audio = AudioPlayer()
+        self.diagnostics_topic = Topic(self, '/sim/diagnostics', 'diagnostic_msgs/DiagnosticArray')
         self.colors = {
             # https://coolors.co/292f36-d7263d-ffffff-197bbd-058c42
             'grey': (41, 47, 54), # grey
@@ -438,22 +885,372 @@ class RosSimulator:
             'green' : (5,140,66), # green
             'blue' : (25,123,189) # blue
         }
-        self.background = self.create_background()
+        self.startup_ms['pygame'] = (time.perf_counter() - started) * 1e3
+        if map_path:
+            self.load_map(map_path)
+        else:
+            self.set_background(self.create_background())
+        self.startup_ms['map'] = (time.perf_counter() - started) * 1e3 - sum(self.startup_ms.values())
         # set caption
-        pygame.display.set_caption('Create3 Robot Simulation')
-
-        self.is_connected = True
-        # main player robot
-        self.robot_name = robot_name
-        self.main_robot = Create3(self.screen, self, robot_name)
-        self.robots.add(self.main_robot)
-
-        self.broadcast_payload = None # callback to send messages to the network
+        if not headless:
+            pygame.display.set_caption('Create3 Robot Simulation')
+
+        # robots, the first one is the main player robot
+        robot_names = [robot_name] if isinstance(robot_name, str) else list(robot_name)
+        start_poses = start_poses or {}
+        # the default arena is free around the origin, a map's origin is often a corner or inside a wall
+        default_poses = self.grid_poses(len(robot_names), center=self.map_center() if map_path else (0, 0))
+        if map_path:
+            default_poses = [self.free_position(x, y) + (theta,) for x, y, theta in default_poses]
+        self.robot_name = robot_names[0]
+        self.robots_by_name = {}
+        self.start_poses = {} # robot name -> (x, y, theta), where /sim/reset puts it back
+        for name, pose in zip(robot_names, default_poses):
+            self.start_poses[name] = tuple(start_poses.get(name, pose))
+            robot = Create3(self.screen, self, name, self.start_poses[name], publish_rates)
+            self.robots_by_name[name] = robot
+            self.robots.add(robot)
+        self.main_robot = self.robots_by_name[self.robot_name]
+        self.startup_ms['robots'] = (time.perf_counter() - started) * 1e3 - sum(self.startup_ms.values())
+        self.follow_robot = self.main_robot # the robot the camera keeps in view
+
+        # optional log of all WebSocket traffic, and a log being replayed
+        self.recorder = None
+        self.replay = None
+        # optional shared memory copy of the robots' state for local controllers
+        self.shm_export = None
+
+        # connected WebSocket clients, and the clients subscribed to each topic
+        self.clients = set()
+        self.subscribers = {} # topic name -> set of clients
+        self.cbor_subscribers = {} # topic name -> set of the clients that asked for CBOR
+        self.client_high_water = 64 * 1024 # bytes buffered for a client before its messages are coalesced
+        # calls handed over from other threads (the asyncio engine's event loop), run at the start of each frame
+        self.inbox = deque()
+        self.inbox_ready = threading.Event() # set by call_soon, lets a paused frame loop wake up for it
+        self.inbound_errors = 0 # messages from clients that could not be decoded or handled
+        self.advertisers = {} # topic name -> clients that advertised it
+        self.client_topics = set() # topics created by a client's advertise, removed with their last advertiser
+
+        # lockstep: while paused the world only advances through the /sim/step service
+        self.paused = False
+        self.services = {'/sim/step': self.step_service, '/sim/pause': self.pause_service, '/sim/reset': self.reset_service}
+        self.startup_ms['total'] = (time.perf_counter() - started) * 1e3
+
+    @property
+    def paused(self):
+        return self._paused
+
+    @paused.setter
+    def paused(self, paused):
+        now = self.topic_clock_ns()
+        self._paused = bool(paused)
+        self.rebase_clock(now)
+
+    def topic_clock_ns(self):
+        # follows the wall clock while running and sim time while paused, so lockstep runs time messages out
+        # (e.g. the cmd_vel timeout) the same however long a client takes between /sim/step calls
+        if self._paused:
+            return self.clock_origin_ns + int((self.sim_time - self.clock_origin_sim) * 1e9)
+        return self.clock_origin_ns + time.monotonic_ns() - self.clock_origin_wall
+
+    def rebase_clock(self, now):
+        # continue the topic clock from now (in ns) after pausing, resuming or resetting sim time
+        self.clock_origin_ns = now
+        self.clock_origin_wall = time.monotonic_ns()
+        self.clock_origin_sim = self.sim_time
 
     def add_topic(self, topic):
         self.topic_dict[topic.topic_name] = topic
+
+    def call_soon(self, fn, *args):
+        # run fn(*args) on the simulation thread at the start of the next frame, safe to call from any thread
+        self.inbox.append(functools.partial(fn, *args))
+        self.inbox_ready.set()
+
+    def wait_inbox(self, timeout):
+        # block until call_soon was called or timeout seconds passed
+        self.inbox_ready.wait(timeout)
+        self.inbox_ready.clear()
+
+    def run_inbox(self):
+        while self.inbox:
+            fn = self.inbox.popleft()
+            try:
+                fn()
+            except Exception as e:
+                self.inbound_error(getattr(fn.func, '__qualname__', fn.func), e)
+
+    def inbound_error(self, source, error):
+        # count and report a message that could not be decoded or handled
+        self.inbound_errors += 1
+        print(f'Could not handle {source} ({self.inbound_errors} errors so far): {error!r}')
+
+    def add_client(self, client):
+        self.clients.add(client)
+        self.is_connected = True
+        # clear alert message if connected
+        self.set_alert('')
+
+    def remove_client(self, client):
+        self.clients.discard(client)
+        for clients in self.subscribers.values():
+            clients.discard(client)
+        for clients in self.cbor_subscribers.values():
+            clients.discard(client)
+        for topic_name in [name for name, clients in self.advertisers.items() if client in clients]:
+            self.unadvertise(topic_name, client)
+        if not self.clients:
+            self.is_connected = False
+            self.set_alert('Not Connected')
+
+    def subscribe_client(self, client, topic_name, compression='none'):
+        # compression is the rosbridge subscribe option, 'cbor' (and 'cbor-raw') clients get binary CBOR frames
+        self.subscribers.setdefault(topic_name, set()).add(client)
+        if compression in ('cbor', 'cbor-raw') and ros_messages.cbor2 is not None:
+            self.cbor_subscribers.setdefault(topic_name, set()).add(client)
+        else:
+            if compression in ('cbor', 'cbor-raw'):
+                print(f'cbor2 is not installed, sending {topic_name} as JSON')
+            self.cbor_subscribers.get(topic_name, set()).discard(client)
+
+    def unsubscribe_client(self, client, topic_name):
+        self.subscribers.get(topic_name, set()).discard(client)
+        self.cbor_subscribers.get(topic_name, set()).discard(client)
+
+    def advertise(self, topic_name, message_type='', client=None):
+        # a client will publish on topic_name, make sure the topic exists so its messages are kept
+        if topic_name not in self.topic_dict:
+            Topic(self, topic_name, message_type)
+            self.client_topics.add(topic_name)
+        self.advertisers.setdefault(topic_name, set()).add(client)
+
+    def unadvertise(self, topic_name, client=None):
+        # a client stopped publishing on topic_name, a topic only clients publish on goes away with the last of them
+        advertisers = self.advertisers.get(topic_name, set())
+        advertisers.discard(client)
+        if not advertisers:
+            self.advertisers.pop(topic_name, None)
+            if topic_name in self.client_topics:
+                self.client_topics.discard(topic_name)
+                del self.topic_dict[topic_name]
+
+    def publish_inbound(self, topic_name, msg):
+        # a client (or a replayed log) published msg on topic_name
+        topic = self.topic_dict.get(topic_name)
+        if topic is not None:
+            topic.publish(msg)
+
+    def publish_inbound_raw(self, topic_name, payload):
+        # a client published the rosbridge JSON frame payload on topic_name, only decoded if something needs it now
+        topic = self.topic_dict.get(topic_name)
+        if topic is None:
+            return
+        if topic.callbacks:
+            try:
+                msg = ros_messages.loads(payload).get('msg')
+            except Exception as e:
+                self.inbound_error(f'{topic_name} message', e)
+                return
+            topic.publish(msg)
+        else:
+            topic.publish_raw(payload)
+
+    def call_service(self, service, args):
+        # run a rosbridge call_service request, returns the response values
+        if service not in self.services:
+            raise ValueError(f'unknown service {service}, expected one of {list(self.services)}')
+        return self.services[service](args or {})
+
+    def step_service(self, args):
+        # /sim/step {steps: K}: pause the free running clock and advance exactly K physics steps
+        steps = int(args.get('steps', 1))
+        if steps < 0:
+            raise ValueError(f'steps must not be negative, got {steps}')
+        self.paused = True
+        for _ in range(steps):
+            if not self.running:
+                break
+            self.step()
+        return self.state()
+
+    def pause_service(self, args):
+        # /sim/pause {paused: true|false}: stop or restart the free running clock
+        self.paused = bool(args.get('paused', True))
+        return self.state()
+
+    def reset_service(self, args):
+        # /sim/reset: every robot back at its start pose, sim time back at 0
+        self.reset()
+        return self.state()
+
+    def state(self):
+        # sim time, and each robot's odometry, IR intensities and collision flag, as returned by the /sim services
+        fleet = self.fleet
+        return {
+            'sim_time': self.sim_time,
+            'step_count': self.step_count,
+            'paused': self.paused,
+            'robots': {robot.name: {
+                'odom': {'x': float(fleet.x[i]), 'y': float(fleet.y[i]), 'theta': float(fleet.theta[i]),
+                         'v': float(fleet.v[i]), 'theta_dot': float(fleet.theta_dot[i])},
+                'ir': fleet.ir[i].tolist(),
+                'collision': bool(fleet.collision[i]),
+            } for i, robot in enumerate(fleet.robots)},
+        }
+
+    def reset(self):
+        fleet = self.fleet
+        for robot in fleet.robots:
+            robot.x, robot.y, robot.theta = self.start_poses[robot.name]
+            robot.v = robot.theta_dot = 0.0
+            robot.cmd_vel_topic.msg = None # a stale command would drive the robot away again
+            for topic_name in robot.next_publish:
+                robot.next_publish[topic_name] = 0.0
+        fleet.collision[:] = False
+        fleet.collisions[:] = 0
+        fleet.sense()
+        now = self.topic_clock_ns()
+        self.sim_time = 0.0
+        self.rebase_clock(now)
+        self.step_count = 0
+        self.accumulator = 0.0
+        self.full_redraw = True
+        if self.shm_export:
+            self.shm_export.write()
+
+    def client_stats(self):
+        # peer -> messages sent, messages waiting and per topic drop counts of every connected client
+        return {client.peer: {'sent': client.sent, 'queued': len(client.pending), 'dropped': dict(client.dropped)}
+                for client in self.clients if hasattr(client, 'dropped')}
+
+    def has_subscribers(self, topic_name):
+        return bool(self.subscribers.get(topic_name))
+
+    def broadcast_payload(self, payload):
+        # encode the message once per encoding and send the same bytes to every client subscribed to its topic
+        if self.has_subscribers(payload['topic']):
+            self.broadcast(payload['topic'], lambda: ros_messages.dumps(payload), lambda: ros_messages.cbor_dumps(payload))
+
+    def broadcast_template(self, template, *values):
+        # publish a ros_messages.MessageTemplate filled with values
+        self.broadcast(template.topic, lambda: template.encode(*values), lambda: template.encode_cbor(*values))
+
+    def broadcast(self, topic_name, encode, encode_cbor):
+        # send a message to every client subscribed to topic_name, encode() and encode_cbor() return it as
+        # JSON or CBOR bytes and are only called if a client wants that encoding
+        clients = self.subscribers.get(topic_name)
+        if not clients:
+            return
+        cbor_clients = self.cbor_subscribers.get(topic_name, ())
+        data = cbor_data = None
+        for client in list(clients):
+            if client in cbor_clients:
+                if cbor_data is None:
+                    cbor_data = encode_cbor()
+                    if self.recorder:
+                        self.recorder.record(sim_recorder.OUTBOUND | sim_recorder.BINARY, self.step_count, cbor_data)
+                client.send_encoded(cbor_data, True, topic_name)
+            else:
+                if data is None:
+                    data = encode()
+                    if self.recorder:
+                        self.recorder.record(sim_recorder.OUTBOUND, self.step_count, data)
+                client.send_encoded(data, False, topic_name)
+
+    @staticmethod
+    def grid_poses(count, spacing=0.4, center=(0, 0)):
+        # (x, y, theta) start poses on a square grid centred on center, a single robot starts at center
+        cols = int(numpy.ceil(numpy.sqrt(count)))
+        rows = int(numpy.ceil(count / cols)) if count else 0
+        cx, cy = center
+        return [(cx + (i % cols - (cols - 1) / 2) * spacing, cy + ((rows - 1) / 2 - i // cols) * spacing, 0) for i in range(count)]
+
+    def map_center(self):
+        # (x, y) in meters of the middle of the map
+        width, height = self.background.get_size()
+        ox, oy = self.map_origin
+        return (ox + width / 2 / self.pixel_per_meter, oy + height / 2 / self.pixel_per_meter)
+
+    def free_position(self, x, y):
+        # the (x, y) in meters near x, y where a robot is clear of every wall, x, y itself if the map has no such place
+        width, height = self.wall_distance.shape
+        px, py = self.to_pixels(x, y)
+        px, py = min(max(int(px), 0), width - 1), min(max(int(py), 0), height - 1)
+        reach = 16 # pixels, searched in growing windows so large maps are not scanned whole
+        while True:
+            left, top = max(px - reach, 0), max(py - reach, 0)
+            # farther than max_wall_distance is farther than any robot radius
+            clear = numpy.argwhere(self.wall_distance[left:px + reach + 1, top:py + reach + 1] >= self.max_wall_distance)
+            if len(clear):
+                cx, cy = clear[numpy.argmin((clear[:, 0] + left - px) ** 2 + (clear[:, 1] + top - py) ** 2)] + (left, top)
+                ox, oy = self.map_origin
+                return (float(ox + (cx + 0.5) / self.pixel_per_meter), float(oy + (height - cy - 0.5) / self.pixel_per_meter))
+            if reach >= max(width, height):
+                return (x, y)
+            reach *= 2
+
+    def to_pixels(self, x, y):
+        # convert positions in meters (scalars or arrays) to map pixels, map_origin is the map's lower left corner
+        ox, oy = self.map_origin
+        return ((x - ox) * self.pixel_per_meter, self.background.get_height() - (y - oy) * self.pixel_per_meter)
+
+    def to_screen(self, x, y):
+        # convert map pixels (scalars or arrays) to window pixels
+        return (x * self.display_scale - self.camera.left, y * self.display_scale - self.camera.top)
      
 
+    def set_background(self, background, wall_map=None, origin=None):
+        # the occupancy grid is only rebuilt here, when the map actually changes
+        # wall_map defaults to the dark pixels of background, origin (the lower left corner in meters) to centring the map
+        self.background = background
+        self.full_redraw = True
+        self.wall_map = self.build_wall_map(background) if wall_map is None else wall_map
+        self.max_wall_distance = int(numpy.ceil(self.wall_distance_range * self.pixel_per_meter)) # in map pixels
+        # the slowest part of starting up, so it is cached on disk for every map
+        self.wall_distance = sim_assets.cached_array(
+            'wall_distance', self.wall_map.tobytes() + repr((self.wall_map.shape, self.max_wall_distance, DISTANCE_TRANSFORM_VERSION)).encode(),
+            lambda: distance_transform(self.wall_map, self.max_wall_distance))
+        width, height = background.get_size()
+        self.map_origin = origin or (-width / 2 / self.pixel_per_meter, -height / 2 / self.pixel_per_meter)
+        # the map is drawn from tiles at the display scale, through a window sized camera
+        self.display_scale = self.display_pixel_per_meter / self.pixel_per_meter
+        self.tiles = sim_map.TileCache(background, self.display_scale)
+        self.camera = sim_map.Camera(self.screen.get_size(), self.tiles.display_size)
+        self.view = pygame.Surface(self.screen.get_size())
+
+    def load_map(self, path):
+        # load a map_server map, robots keep their poses in meters and are rescaled to its resolution
+        loaded = sim_map.load_map(path, self.colors['blue'])
+        self.pixel_per_meter = 1 / loaded.resolution
+        self.set_background(loaded.surface, loaded.wall_map, loaded.origin)
+        for robot in self.fleet.robots:
+            robot.scale_to_map()
+            self.fleet.radius[robot.index] = robot.radius
+
+    def follow(self, robot_name):
+        # keep robot_name in view
+        self.follow_robot = self.robots_by_name[robot_name]
+
+    @staticmethod
+    def build_wall_map(background):
+        # boolean occupancy grid indexed [x, y], True where the pixel is a wall
+        return pygame.surfarray.array_red(background) < 60  # Check for a "wall"
+
+    def is_wall(self, point):
+        # checks the occupancy grid at point (in pixels); anything off the map counts as a wall
+        x, y = int(point[0]), int(point[1])
+        if 0 <= x < self.wall_map.shape[0] and 0 <= y < self.wall_map.shape[1]:
+            return bool(self.wall_map[x, y])
+        return True
+
+    def wall_distance_at(self, point):
+        # distance in pixels from point to the nearest wall (capped at max_wall_distance), 0 off the map
+        x, y = int(point[0]), int(point[1])
+        if 0 <= x < self.wall_distance.shape[0] and 0 <= y < self.wall_distance.shape[1]:
+            return float(self.wall_distance[x, y])
+        return 0.0
+
     def create_background(self):
         W = self.screen.get_width()
         H = self.screen.get_height()
@@ -484,30 +1281,201 @@ class RosSimulator:
     def set_alert(self, msg):
         self.alert_msg = msg
 
-    def run_once(self):
-        # Non-blocking loop to run game continuously!
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                print('Exiting...')
+    def set_real_time_factor(self, real_time_factor):
+        # the loop runs at the render rate, the real time factor only changes how
+        # many physics steps each loop iteration advances
+        self.real_time_factor = real_time_factor
+        if real_time_factor:
+            self.frame_rate = self.render_rate
+            self.loop_interval = 1 / (self.render_rate + 1)
+        else:
+            # as fast as possible: no frame cap and no pause between loop calls
+            self.frame_rate = 0
+            self.loop_interval = 0
+
+    def steps_due(self, now):
+        # number of physics steps to run now to keep sim time at real_time_factor x wall clock time
+        if not self.real_time_factor:
+            return self.fast_steps
+        if self.last_tick is None:
+            self.last_tick = now
+        elapsed = min(now - self.last_tick, self.max_frame_time)
+        self.last_tick = now
+        self.accumulator += elapsed * self.real_time_factor
+        steps = int(self.accumulator / self.physics_dt)
+        self.accumulator -= steps * self.physics_dt
+        return steps
+
+    def start_recording(self, path):
+        # write every inbound message and outbound publish to the log at path, timed by the topic clock
+        self.recorder = sim_recorder.Recorder(path, lambda: self.clock_ns() / 1e9)
+
+    def start_shm_export(self, name):
+        # write every robot's state to the shared memory block name after each physics step (see shm_export.py)
+        import shm_export # multiprocessing is only imported when asked for
+        self.shm_export = shm_export.SharedStateExporter(self, name)
+
+    def start_replay(self, path):
+        # feed the inbound messages recorded in the log at path back in, the simulator stops at the end of the log
+        self.replay = sim_recorder.Replay(path)
+        self.clock_ns = self.replay.clock_ns
+
+    def topic_stats(self):
+        # topic name -> arrival statistics (see TopicStats.summary) of every topic
+        now = self.clock_ns()
+        return {name: topic.stats.summary(now) for name, topic in self.topic_dict.items()}
+
+    def step(self):
+        # advance the world by exactly one physics step
+        if self.replay:
+            self.replay.feed(self)
+            if self.replay.finished and self.step_count >= self.replay.last_step:
+                print('Replay finished')
+                self.replay = None
                 self.running = False
+                return
+        self.fleet.update(self.physics_dt)
+        self.sim_time += self.physics_dt
+        self.step_count += 1
+        start = time.perf_counter_ns()
+        for robot in self.fleet.robots:
+            robot.publish_sensors(self.sim_time)
+        if self.shm_export:
+            self.shm_export.write()
+        self.profiler.record('publish', start)
 
-        # Draw background
-        self.screen.blit(self.background, (0, 0))
-
-        # Update all robots
-        self.robots.update()
-        self.robots.draw(self.screen)
+    def run_once(self):
+        start = time.perf_counter()
+        frame_start = time.perf_counter_ns()
+        self.run_inbox()
 
-        # put fps in top left corner
-        fps = self.clock.get_fps()
-        font = pygame.font.Font(None, 24)
-        text = font.render(f'v{self.version} FPS: {fps:.2f}', True, self.colors.get('green', (0, 0, 255)))
-        self.screen.blit(text, (10, 10))
+        # Non-blocking loop to run game continuously!
+        if not self.headless:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    print('Exiting...')
+                    self.running = False
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                    # toggle the profiler overlay
+                    self.show_profiler = not self.show_profiler
+                    self.full_redraw = True
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_TAB:
+                    # follow the next robot
+                    names = list(self.robots_by_name)
+                    self.follow(names[(names.index(self.follow_robot.name) + 1) % len(names)])
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_F4:
+                    self.profiler.start_profile(300, f'sim_{time.strftime("%Y%m%d_%H%M%S")}.prof')
+            self.profiler.record('events', frame_start)
+
+        if self.paused:
+            # lockstep: the clock does not build up steps while paused
+            self.last_tick = None
+        else:
+            for _ in range(self.steps_due(start)):
+                self.step()
+
+        if not self.headless:
+            # skip rendering while physics uses up the whole frame budget, but never for too long
+            behind = time.perf_counter() - start > 1 / self.render_rate
+            if behind and self.skipped_frames < self.max_skipped_frames:
+                self.skipped_frames += 1
+            else:
+                self.skipped_frames = 0
+                render_start = time.perf_counter_ns()
+                self.render()
+                self.profiler.record('render', render_start)
+
+        if time.monotonic() - self.diagnostics_published >= self.diagnostics_period:
+            self.publish_diagnostics()
+
+        self.profiler.record('frame', frame_start)
+        self.profiler.end_frame()
+        # paused frames are not capped, they only run when a client asked for something (see asyncio_server.run)
+        self.clock.tick(0 if self.paused else self.frame_rate)
+
+    def publish_diagnostics(self):
+        # frame stage timings and topic rates as a diagnostic_msgs/DiagnosticArray on /sim/diagnostics
+        self.diagnostics_published = time.monotonic()
+        topic_name = self.diagnostics_topic.topic_name
+        if not self.has_subscribers(topic_name):
+            return
+        status = [{
+            'level': 0, 'name': 'sim/loop', 'message': f'{self.clock.get_fps():.1f} fps', 'hardware_id': 'create3_simulator',
+            'values': [{'key': 'fps', 'value': f'{self.clock.get_fps():.2f}'},
+                       {'key': 'sim_time', 'value': f'{self.sim_time:.3f}'},
+                       {'key': 'real_time_factor', 'value': str(self.real_time_factor)},
+                       {'key': 'paused', 'value': str(self.paused)},
+                       {'key': 'inbound_errors', 'value': str(self.inbound_errors)},
+                       {'key': 'startup_ms', 'value': f"{self.startup_ms['total']:.1f}"},
+                       {'key': 'robots', 'value': str(len(self.fleet))}]
+        }]
+        for stage, stats in self.profiler.summary().items():
+            status.append({
+                'level': 0, 'name': f'sim/{stage}', 'message': f"{stats['p50_ms']:.3f} ms median", 'hardware_id': 'create3_simulator',
+                'values': [{'key': key, 'value': str(value)} for key, value in stats.items()]
+            })
+        for name, stats in self.topic_stats().items():
+            if not stats['count']:
+                continue
+            status.append({
+                'level': 0, 'name': f'topic{name}', 'message': f"{stats['rate_hz']:.1f} Hz", 'hardware_id': 'create3_simulator',
+                'values': [{'key': key, 'value': str(value)} for key, value in stats.items()]
+            })
+        for peer, stats in self.client_stats().items():
+            dropped = sum(stats['dropped'].values())
+            status.append({
+                'level': 1 if stats['queued'] else 0, 'name': f'client/{peer}', 'message': f'{dropped} dropped', 'hardware_id': 'create3_simulator',
+                'values': [{'key': 'sent', 'value': str(stats['sent'])}, {'key': 'queued', 'value': str(stats['queued'])}] +
+                          [{'key': f'dropped{topic}', 'value': str(count)} for topic, count in stats['dropped'].items()]
+            })
+        seconds = int(self.sim_time)
+        self.broadcast_payload({
+            'op': 'publish',
+            'topic': topic_name,
+            'msg': {'header': {'stamp': {'sec': seconds, 'nanosec': int((self.sim_time - seconds) * 1e9)}, 'frame_id': ''},
+                    'status': status}
+        })
+
+    def render(self):
+        # only the parts of the screen that changed are redrawn and sent to the display
+        px, py = self.follow_robot.get_pixel_position()
+        if self.camera.follow(px * self.display_scale, py * self.display_scale):
+            self.full_redraw = True
+        if self.full_redraw:
+            # compose the visible map tiles, the view is what we erase from until the camera moves again
+            self.tiles.draw(self.view, self.camera, self.colors['grey'])
+            self.screen.blit(self.view, (0, 0))
+            dirty = [self.screen.get_rect()]
+            self.full_redraw = False
+        else:
+            # erase what we drew last frame
+            dirty = self.drawn_rects
+            for rect in dirty:
+                self.screen.blit(self.view, rect, rect)
+
+        drawn = []
+        for robot in self.robots:
+            drawn.extend(robot.render(self.screen))
+        drawn.extend(self.robots.draw(self.screen))
+
+        # put fps in top left corner, refreshed a few times per second
+        now = time.monotonic()
+        if now - self.fps_updated > 0.5:
+            self.fps_updated = now
+            self.fps_text = f'v{self.version} FPS: {self.clock.get_fps():.2f}'
+            if self.show_profiler:
+                self.profiler_text = [f"{stage:<8} {stats['p50_ms']:7.3f} ms  p95 {stats['p95_ms']:7.3f} ms"
+                                      for stage, stats in self.profiler.summary().items()]
+        drawn.append(self.screen.blit(self.render_text(self.fps_text, 'green'), (10, 10)))
 
         # if alert message, put it below fps
         if self.alert_msg:
-            text = font.render(self.alert_msg, True, self.colors.get('red', (255, 0, 0)))
-            self.screen.blit(text, (10, 40))
+            drawn.append(self.screen.blit(self.render_text(self.alert_msg, 'red'), (10, 40)))
+
+        # profiler overlay (F3) below that
+        if self.show_profiler:
+            for i, line in enumerate(self.profiler_text):
+                drawn.append(self.screen.blit(self.render_text(line, 'grey'), (10, 70 + 20 * i)))
 
 
         # if 'p' pressed, take a screenshot
@@ -517,37 +1485,101 @@ class RosSimulator:
             # sleep for 1 second to prevent multiple screenshots
             pygame.time.wait(1000)
 
-        
-        self.clock.tick(60)
-        pygame.display.flip()
+        pygame.display.update(dirty + drawn)
+        self.drawn_rects = drawn
+
+    def render_text(self, text, color):
+        # text surfaces are only rendered again when their text changes
+        key = (text, color)
+        surface = self.text_cache.get(key)
+        if surface is None:
+            if len(self.text_cache) > 32:
+                self.text_cache.clear()
+            surface = self.font.render(text, True, self.colors.get(color, (255, 0, 0)))
+            self.text_cache[key] = surface
+        return surface
     
+    def close(self):
+        # shut down after the frame loop stopped, safe to call again
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+        if self.shm_export:
+            self.shm_export.close()
+            self.shm_export = None
+        pygame.quit()
+
     def run_with_exit(self, reactor):
         if self.running:
             self.run_once()
         else: 
-            pygame.quit()
+            self.close()
             reactor.stop()
 
+def __getattr__(name):
+    # the Twisted server used to live here, it is only imported when asked for
+    if name in ('WebSocketProtocol', 'listen'):
+        import twisted_server
+        return getattr(twisted_server, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 def main():
+    parser = argparse.ArgumentParser(description='Create3 robot simulator with a rosbridge-style WebSocket server')
+    parser.add_argument('--name', nargs='+', default=['juliet'], help='robot name(s) used as the topic namespace, one robot per name')
+    parser.add_argument('--port', type=int, default=9012, help='WebSocket port')
+    parser.add_argument('--headless', action='store_true', help='run without a window (no drawing)')
+    parser.add_argument('--rtf', type=float, default=1.0, help='real time factor, e.g. 10 for 10x; 0 runs as fast as possible')
+    parser.add_argument('--physics-rate', type=float, default=200, help='physics and sensor rate in Hz')
+    parser.add_argument('--profiler-overlay', action='store_true', help='show frame stage timings on screen (toggle with F3)')
+    parser.add_argument('--profile-frames', type=int, default=0, help='run cProfile over this many frames (F4 profiles 300)')
+    parser.add_argument('--profile-out', default='sim.prof', help='where --profile-frames writes its stats')
+    parser.add_argument('--record', metavar='LOG', help='write all WebSocket traffic to this binary log')
+    parser.add_argument('--replay', metavar='LOG', help='replay the inputs recorded in this log (use --rtf 0 for as fast as possible)')
+    parser.add_argument('--paused', action='store_true', help='start paused, the world only advances through the /sim/step service')
+    parser.add_argument('--shm', metavar='NAME', help='also export the robots\' state to this shared memory block (see shm_export.py)')
+    parser.add_argument('--map', help='ROS map_server map to load (YAML, or a PGM/PNG image at 0.05 m per pixel)')
+    parser.add_argument('--start-pose', nargs=3, type=float, action='append', default=[], metavar=('X', 'Y', 'THETA'),
+                        help='start pose in meters/radians, once per robot in --name order (default: a grid around the '
+                             'origin, or the clear space nearest the middle of the --map)')
+    parser.add_argument('--follow', help='name of the robot the camera follows (Tab cycles through the robots)')
+    parser.add_argument('--engine', choices=['twisted', 'asyncio'], default='twisted',
+                        help='twisted runs everything on the reactor, asyncio does network I/O on its own thread (see asyncio_server.py)')
+    args = parser.parse_args()
 
     ip = '0.0.0.0'
-    port = 9012
-    robot_name = 'juliet'
-
-
-    ros = RosSimulator(robot_name)
-
-    # Set up WebSocket server
-    factory = WebSocketServerFactory(f"ws://{ip}:{port}")
-    factory.protocol = lambda: WebSocketProtocol(ros)
-    reactor.listenTCP(port, factory)
-
-    # Integrate Pygame loop with Twisted reactor
-    pygame_task = task.LoopingCall(ros.run_with_exit, reactor)
-    pygame_task.start(1/61)
-
-    print(f"Simulated Robot: {robot_name} on ws://{ip}:{port}")
-    reactor.run()
+    port = args.port
+    robot_name = args.name
+
+
+    if len(args.start_pose) > len(robot_name):
+        parser.error(f'{len(args.start_pose)} --start-pose for {len(robot_name)} robots')
+    start_poses = dict(zip(robot_name, args.start_pose))
+
+    ros = RosSimulator(robot_name, headless=args.headless, real_time_factor=args.rtf, start_poses=start_poses,
+                       physics_rate=args.physics_rate, map_path=args.map)
+    stages = ', '.join(f'{stage} {ms:.0f} ms' for stage, ms in ros.startup_ms.items() if stage != 'total')
+    print(f"Simulator started in {ros.startup_ms['total']:.0f} ms ({stages})")
+    ros.paused = args.paused
+    if args.follow:
+        ros.follow(args.follow)
+    ros.show_profiler = args.profiler_overlay
+    if args.profile_frames:
+        ros.profiler.start_profile(args.profile_frames, args.profile_out)
+    if args.record:
+        ros.start_recording(args.record)
+    if args.replay:
+        ros.start_replay(args.replay)
+    if args.shm:
+        ros.start_shm_export(args.shm)
+
+    # only the chosen engine is imported, autobahn can only use one networking framework per process
+    if args.engine == 'asyncio':
+        import asyncio_server as engine
+    else:
+        import twisted_server as engine
+
+    print(f"Simulated Robots: {', '.join(robot_name)} on ws://{ip}:{port}")
+    engine.run(ros, port, ip)
 
 if __name__ == "__main__":
     main()
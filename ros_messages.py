@@ -0,0 +1,147 @@
+"""
+Message encoding for the simulator's rosbridge-style WebSocket server.
+
+Functions:
+    dumps(obj): encode obj as compact JSON bytes, using orjson when it is installed.
+    loads(data): decode JSON bytes or str.
+    cbor_dumps(obj), cbor_loads(data): the same for CBOR (rosbridge's binary `compression: "cbor"`), needs cbor2.
+    odom_template(topic), imu_template(topic), ir_template(topic): cached publish messages for the sensor topics.
+Classes:
+    MessageTemplate: a publish message whose skeleton is encoded once, so each publish only formats the numbers that change.
+"""
+import json
+import struct
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+if orjson is not None:
+    def dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    loads = orjson.loads
+else:
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf8')
+
+    loads = json.loads
+
+
+if cbor2 is not None:
+    cbor_dumps = cbor2.dumps
+    cbor_loads = cbor2.loads
+else:
+    def cbor_dumps(obj):
+        raise RuntimeError('CBOR encoding needs the cbor2 package')
+
+    cbor_loads = cbor_dumps
+
+
+# placeholder for a value that changes on every publish
+SLOT = ''
+
+# CBOR floats in the skeleton are written in their shortest form, these float64s stand in for the slots
+CBOR_FLOAT = struct.Struct('>Bd')
+
+def cbor_marker(index):
+    # a float only float64 can represent, unique to the slot at index
+    return float.fromhex(f'0x1.c3c3c3c3c{index:04x}p-1000')
+
+# covariance matrices are 36 flat floats in ROS, we never estimate them
+ZERO_COVARIANCE = [0.0] * 36
+
+# IrIntensityVector readings are ordered right to left
+IR_FRAME_NAMES = [f'ir_intensity_{name}' for name in reversed(
+    ['side_left', 'left', 'front_left', 'front_center_left', 'front_center_right', 'front_right', 'right'])]
+
+
+def fill(node, values):
+    # copy of the message node with the SLOTs replaced by the next items of the values iterator
+    if isinstance(node, dict):
+        return {key: fill(value, values) for key, value in node.items()}
+    if isinstance(node, list):
+        return [fill(value, values) for value in node]
+    return next(values) if node == SLOT else node
+
+
+class MessageTemplate:
+    """
+    A rosbridge publish message with a constant skeleton. msg is a normal message dict with SLOT in place
+    of every value that changes; the skeleton is JSON encoded once and split at the slots, so encode()
+    only formats the new numbers (in document order) into the pre-encoded fragments. encode_cbor() does
+    the same with a CBOR encoded skeleton, packing the numbers as float64.
+    """
+
+    def __init__(self, topic, msg):
+        self.topic = topic
+        self.msg = msg
+        skeleton = json.dumps({'op': 'publish', 'topic': topic, 'msg': msg}, separators=(',', ':'), ensure_ascii=False)
+        fragments = skeleton.split(f'"{SLOT}"')
+        self.slot_count = len(fragments) - 1
+        # %r of a python float is the same text json.dumps writes
+        self.format = '%r'.join(fragment.replace('%', '%%') for fragment in fragments)
+        self.cbor_fragments = None
+        if cbor2 is not None:
+            # canonical CBOR sorts the keys, so the slots can end up in a different order than in the JSON
+            skeleton = cbor2.dumps(self.message(*map(cbor_marker, range(self.slot_count))), canonical=True)
+            positions = sorted((skeleton.index(CBOR_FLOAT.pack(0xfb, cbor_marker(i))), i) for i in range(self.slot_count))
+            self.cbor_order = [i for _, i in positions]
+            starts = [0] + [position + CBOR_FLOAT.size for position, _ in positions]
+            ends = [position for position, _ in positions] + [len(skeleton)]
+            self.cbor_fragments = [skeleton[start:end] for start, end in zip(starts, ends)]
+
+    def encode(self, *values):
+        # values must be finite numbers, numpy scalars are converted so %r gives plain numbers
+        return (self.format % tuple(map(float, values))).encode('utf8')
+
+    def encode_cbor(self, *values):
+        # the same message as encode(), as CBOR
+        fragments = self.cbor_fragments
+        if fragments is None:
+            return cbor_dumps(self.message(*values))
+        parts = [fragments[0]]
+        for i, fragment in zip(self.cbor_order, fragments[1:]):
+            parts.append(CBOR_FLOAT.pack(0xfb, values[i]))
+            parts.append(fragment)
+        return b''.join(parts)
+
+    def message(self, *values):
+        # the same message as encode(), as a dict
+        return {'op': 'publish', 'topic': self.topic, 'msg': fill(self.msg, iter(map(float, values)))}
+
+
+def odom_template(topic):
+    # values: x, y, orientation z, orientation w, linear x, angular z
+    return MessageTemplate(topic, {
+        'pose': {
+            'pose': {'position': {'x': SLOT, 'y': SLOT, 'z': 0.0}, 'orientation': {'x': 0.0, 'y': 0.0, 'z': SLOT, 'w': SLOT}},
+            'covariance': ZERO_COVARIANCE
+        },
+        'twist': {
+            'twist': {'linear': {'x': SLOT, 'y': 0.0, 'z': 0.0}, 'angular': {'x': 0.0, 'y': 0.0, 'z': SLOT}},
+            'covariance': ZERO_COVARIANCE
+        }
+    })
+
+def imu_template(topic):
+    # values: orientation z, orientation w, angular velocity z
+    # https://iroboteducation.github.io/create3_docs/api/odometry/
+    return MessageTemplate(topic, {
+        'orientation': {'x': 0.0, 'y': 0.0, 'z': SLOT, 'w': SLOT},
+        'angular_velocity': {'x': 0.0, 'y': 0.0, 'z': SLOT},
+        'linear_acceleration': {'x': 0.0, 'y': 0.0, 'z': 0.0},
+    })
+
+def ir_template(topic):
+    # values: one intensity per IR sensor, in IR_FRAME_NAMES order
+    return MessageTemplate(topic, {
+        'readings': [{'header': {'frame_id': frame_id}, 'value': SLOT} for frame_id in IR_FRAME_NAMES]
+    })
@@ -0,0 +1,144 @@
+"""
+The rosbridge protocol as seen by the simulator, independent of the networking framework.
+
+RosbridgeProtocol is mixed into the WebSocket protocol classes of both engines: twisted_server.py (the
+default, everything on the reactor) and asyncio_server.py (network I/O on its own thread). It keeps one
+client's subscriptions, turns incoming frames into simulator calls (one handler per rosbridge op), and
+coalesces outbound messages per topic while the client's write buffer is full.
+"""
+import functools
+import re
+
+import ros_messages
+import sim_recorder
+
+# start of a rosbridge publish frame as roslibpy writes it, read without decoding the whole frame
+PUBLISH_HEADER = re.compile(rb'\{\s*"op"\s*:\s*"publish"\s*,\s*(?:"id"\s*:\s*"[^"\\]*"\s*,\s*)?"topic"\s*:\s*"([^"\\]*)"')
+
+
+class RosbridgeProtocol:
+    """
+    The rosbridge side of a WebSocket client. Subclasses provide the transport: sendMessage() and
+    send_encoded(), and set paused while the client's write buffer is over RosSimulator.client_high_water.
+    While paused only the latest message of each topic is kept, and the ones it replaces are counted as dropped.
+    """
+    # JSON publish frames are handed to the simulator undecoded (see RosSimulator.publish_inbound_raw). Engines
+    # that parse on their own I/O thread turn this off, so the simulation thread never decodes
+    lazy_publish = True
+
+    def __init__(self, ros_instance):
+        super().__init__()
+        self.ros = ros_instance
+        self.peer = None
+        self.subscriptions = {} # topic name -> set of rosbridge subscription ids from this client
+        self.paused = False
+        self.pending = {} # topic name -> (data, is_binary), the latest message of each topic while paused
+        self.sent = 0
+        self.dropped = {} # topic name -> messages replaced by a newer one before they were sent
+
+        self.robot_name = ros_instance.robot_name
+        # rosbridge op -> handler of the decoded message
+        self.ops = {
+            'publish': self.publish,
+            'subscribe': self.subscribe,
+            'unsubscribe': self.unsubscribe,
+            'advertise': self.advertise,
+            'unadvertise': self.unadvertise,
+            'call_service': self.call_service,
+        }
+
+    def receive(self, payload, isBinary):
+        # work out what an incoming frame asks for, without touching the simulator. Returns the call to run
+        # on the simulation thread; JSON publish frames skip decoding here if lazy_publish
+        call = self.parse(payload, isBinary)
+        if self.ros.recorder:
+            return functools.partial(self.record_and_run, payload, isBinary, call)
+        return call
+
+    def record_and_run(self, payload, isBinary, call):
+        # logged on the simulation thread, tagged with the step the frame is applied before, which is where a replay feeds it
+        self.ros.recorder.record(sim_recorder.INBOUND | (sim_recorder.BINARY if isBinary else 0), self.ros.step_count, payload)
+        call()
+
+    def parse(self, payload, isBinary):
+        if self.lazy_publish and not isBinary:
+            header = PUBLISH_HEADER.match(payload)
+            if header is not None:
+                return functools.partial(self.ros.publish_inbound_raw, header[1].decode(), payload)
+        try:
+            # binary frames are CBOR as with rosbridge
+            message = ros_messages.cbor_loads(payload) if isBinary else ros_messages.loads(payload)
+        except Exception as e:
+            return functools.partial(self.ros.inbound_error, f'frame from {self.peer}', e)
+        return functools.partial(self.handle, message)
+
+    def handle(self, message):
+        # act on a decoded rosbridge message, always on the simulation thread
+        try:
+            op = message.get('op', 'publish')
+            handler = self.ops.get(op)
+            if handler is None:
+                raise ValueError(f'unknown op {op!r}')
+            handler(message)
+        except Exception as e:
+            self.ros.inbound_error(f'message from {self.peer}', e)
+
+    def publish(self, message):
+        self.ros.publish_inbound(message.get('topic', ''), message.get('msg', None))
+
+    def subscribe(self, message):
+        topic_name = message.get('topic', '')
+        self.subscriptions.setdefault(topic_name, set()).add(message.get('id'))
+        self.ros.subscribe_client(self, topic_name, message.get('compression', 'none'))
+
+    def unsubscribe(self, message):
+        topic_name = message.get('topic', '')
+        ids = self.subscriptions.get(topic_name, set())
+        ids.discard(message.get('id'))
+        if not ids or message.get('id') is None:
+            # that was the last subscription to this topic
+            self.subscriptions.pop(topic_name, None)
+            self.ros.unsubscribe_client(self, topic_name)
+
+    def advertise(self, message):
+        self.ros.advertise(message.get('topic', ''), message.get('type', ''), self)
+
+    def unadvertise(self, message):
+        self.ros.unadvertise(message.get('topic', ''), self)
+
+    def call_service(self, message):
+        # run the service on the simulator and send its service_response, errors are reported with result false
+        service = message.get('service', '')
+        try:
+            values, result = self.ros.call_service(service, message.get('args')), True
+        except Exception as e:
+            print(f'Service call {service} from {self.peer} failed: {e!r}')
+            values, result = str(e), False
+        response = {'op': 'service_response', 'service': service, 'values': values, 'result': result}
+        if 'id' in message:
+            response['id'] = message['id']
+        data = ros_messages.dumps(response)
+        if self.ros.recorder:
+            self.ros.recorder.record(sim_recorder.OUTBOUND, self.ros.step_count, data)
+        # keyed by the call, so a response is never coalesced with another one
+        self.send_encoded(data, False, (service, message.get('id')))
+
+    def queue_latest(self, topic_name, data, is_binary):
+        # keep data until the client resumes, replacing (and counting) an unsent message of the same topic
+        if topic_name in self.pending:
+            self.dropped[topic_name] = self.dropped.get(topic_name, 0) + 1
+        self.pending[topic_name] = (data, is_binary)
+
+    def send_pending(self):
+        # send the latest message of every topic that published while paused
+        while self.pending and not self.paused:
+            topic_name = next(iter(self.pending))
+            self.write_message(*self.pending.pop(topic_name))
+
+    def write_message(self, data, is_binary):
+        try:
+            self.sendMessage(data, is_binary)
+            self.sent += 1
+        except Exception:
+            print(f'Could not send to {self.peer}, dropping connection')
+            self.ros.call_soon(self.ros.remove_client, self)
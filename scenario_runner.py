@@ -0,0 +1,219 @@
+"""
+Runs many headless simulations in parallel, e.g. to grade a batch of controller scripts against the same arena.
+
+Every scenario runs in its own worker process (a fresh one per scenario, since a Twisted reactor only runs once)
+with its own RosSimulator on an automatically picked port. The controller command is started with {port}
+replaced by that port, and the scenario ends at its time limit (in simulated seconds) or when the controller exits.
+Sim time only starts once the controller has connected, so its startup does not count against the time limit.
+
+Scenario file (JSON), "defaults" are merged into every scenario:
+    {
+        "defaults": {"time_limit": 60, "robots": {"juliet": [0, 0, 0]}, "rtf": 1},
+        "scenarios": [
+            {"name": "alice", "controller": "python controllers/alice.py --port {port}"},
+            {"name": "bob", "controller": "python controllers/bob.py --port {port}", "robots": {"juliet": [0.5, 0, 1.57]}}
+        ]
+    }
+Scenario fields: name, controller (command string or list, run from the scenario file's folder), robots (list of
+names, or name -> [x, y, theta] start pose), time_limit, rtf, physics_rate, publish_rates, map, sample_period,
+wall_time_limit. A scenario that fails (a bad map, a missing controller, an error in the simulation) is reported
+with an "error" in its results, the other scenarios still run.
+
+    python scenario_runner.py scenarios.json --workers 8 --out results.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shlex
+import subprocess
+import tempfile
+import time
+import traceback
+
+SCENARIO_DEFAULTS = {
+    'robots': ['juliet'],
+    'controller': None,
+    'time_limit': 60.0, # simulated seconds
+    'rtf': 1.0,
+    'physics_rate': 200,
+    'publish_rates': None,
+    'map': None,
+    'sample_period': 0.1, # simulated seconds between trajectory samples
+    'wall_time_limit': None, # wall clock seconds before the scenario is stopped anyway, default 3x the expected time + 30 s
+}
+
+
+def load_scenarios(path):
+    with open(path) as f:
+        spec = json.load(f)
+    if isinstance(spec, list):
+        spec = {'scenarios': spec}
+    base = os.path.dirname(os.path.abspath(path))
+    scenarios = []
+    for i, scenario in enumerate(spec['scenarios']):
+        scenario = {**SCENARIO_DEFAULTS, **spec.get('defaults', {}), **scenario}
+        scenario.setdefault('name', f'scenario{i}')
+        scenario['cwd'] = base
+        if scenario['map']:
+            scenario['map'] = os.path.join(base, scenario['map'])
+        scenarios.append(scenario)
+    return scenarios
+
+
+def run_scenario(scenario):
+    # runs in a worker process, returns the scenario's results, or its name and the error that stopped it
+    try:
+        return simulate(scenario)
+    except Exception:
+        return {'name': scenario['name'], 'ended_by': 'error', 'error': traceback.format_exc()}
+
+
+def simulate(scenario):
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    import numpy
+    from twisted.internet import reactor, task
+    import create3_simulator as sim
+    import twisted_server
+
+    robots = scenario['robots']
+    names = list(robots)
+    poses = {name: tuple(pose) for name, pose in robots.items()} if isinstance(robots, dict) else None
+    ros = sim.RosSimulator(names, headless=True, real_time_factor=scenario['rtf'], start_poses=poses,
+                           physics_rate=scenario['physics_rate'], publish_rates=scenario['publish_rates'], map_path=scenario['map'])
+    port = twisted_server.listen(ros, 0, '127.0.0.1').getHost().port
+
+    controller = None
+    if scenario['controller']:
+        command = scenario['controller']
+        command = shlex.split(command) if isinstance(command, str) else list(command)
+        # a file never fills up like a pipe would, so a chatty controller is never blocked on its prints
+        output = tempfile.TemporaryFile()
+        controller = subprocess.Popen([part.replace('{port}', str(port)) for part in command], cwd=scenario['cwd'],
+                                      stdout=output, stderr=subprocess.STDOUT)
+
+    fleet = ros.fleet
+    trajectory = {name: [] for name in names}
+    ir_sum = numpy.zeros(fleet.ir.shape)
+    ir_max = numpy.zeros(fleet.ir.shape)
+    samples = 0
+    next_sample = 0.0
+    result = {'name': scenario['name'], 'port': port, 'ended_by': 'time_limit'}
+    wall_start = time.monotonic()
+
+    def frame():
+        nonlocal samples, next_sample
+        ros.run_once()
+        if ros.sim_time >= next_sample:
+            next_sample += scenario['sample_period']
+            samples += 1
+            numpy.add(ir_sum, fleet.ir, out=ir_sum)
+            numpy.maximum(ir_max, fleet.ir, out=ir_max)
+            for i, name in enumerate(names):
+                trajectory[name].append([round(ros.sim_time, 4), float(fleet.x[i]), float(fleet.y[i]), float(fleet.theta[i])])
+        if ros.sim_time >= scenario['time_limit']:
+            ros.running = False
+        elif controller is not None and controller.poll() is not None:
+            result['ended_by'] = 'controller_exit'
+            ros.running = False
+        if not ros.running:
+            loop.stop()
+            stop()
+
+    def stop():
+        if reactor.running:
+            reactor.stop()
+
+    def failed(failure):
+        # the frame loop raised, it does not run again so stop the reactor instead of waiting forever
+        result['ended_by'] = 'error'
+        result['error'] = failure.getTraceback()
+        stop()
+
+    def out_of_time():
+        result['ended_by'] = 'wall_time_limit'
+        stop()
+
+    wall_time_limit = scenario['wall_time_limit']
+    if wall_time_limit is None:
+        wall_time_limit = 3 * scenario['time_limit'] / (scenario['rtf'] or 1) + 30
+    def wait_for_controller():
+        # the frame loop starts with the controller's first connection (or its exit, which ends the scenario)
+        if ros.clients or controller.poll() is not None:
+            waiting.stop()
+            loop.start(ros.loop_interval).addErrback(failed)
+
+    loop = task.LoopingCall(frame)
+    if controller is None:
+        loop.start(ros.loop_interval).addErrback(failed)
+    else:
+        waiting = task.LoopingCall(wait_for_controller)
+        waiting.start(0.01).addErrback(failed)
+    reactor.callLater(wall_time_limit, out_of_time)
+    reactor.run(installSignalHandlers=False)
+    ros.close()
+
+    if controller is not None:
+        if controller.poll() is None:
+            controller.terminate()
+        try:
+            controller.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            controller.kill()
+            controller.wait()
+        result['controller_returncode'] = controller.returncode
+        # the last 4000 characters, at most 4 bytes each
+        output.seek(max(0, output.seek(0, os.SEEK_END) - 16000))
+        result['controller_output'] = output.read().decode('utf8', 'replace')[-4000:]
+        output.close()
+
+    result.update({
+        'sim_time': ros.sim_time,
+        'wall_time': time.monotonic() - wall_start,
+        'topics': {name: stats for name, stats in ros.topic_stats().items() if stats['count']},
+        'robots': {name: {
+            'collisions': int(fleet.collisions[i]),
+            'final_pose': [float(fleet.x[i]), float(fleet.y[i]), float(fleet.theta[i])],
+            'distance': float(numpy.hypot(*numpy.diff(numpy.asarray(trajectory[name])[:, 1:3], axis=0).T).sum()) if len(trajectory[name]) > 1 else 0.0,
+            'ir_mean': (ir_sum[i] / max(samples, 1)).tolist(),
+            'ir_max': ir_max[i].tolist(),
+            'trajectory': trajectory[name],
+        } for i, name in enumerate(names)},
+    })
+    return result
+
+
+def run_all(scenarios, workers=None):
+    # run the scenarios on a pool of worker processes, results are in scenario order
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers or os.cpu_count(), maxtasksperchild=1) as pool:
+        results = []
+        for result in pool.imap_unordered(run_scenario, scenarios):
+            if 'robots' in result:
+                robots = ', '.join(f"{name}: {robot['collisions']} collisions" for name, robot in result['robots'].items())
+                print(f"{result['name']}: {result['sim_time']:.1f} s simulated in {result['wall_time']:.1f} s ({result['ended_by']}), {robots}")
+            if 'error' in result:
+                print(f"{result['name']}: failed, {result['error'].strip().splitlines()[-1]}")
+            results.append(result)
+    order = {scenario['name']: i for i, scenario in enumerate(scenarios)}
+    return sorted(results, key=lambda result: order[result['name']])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run Create3 simulator scenarios in parallel')
+    parser.add_argument('scenarios', help='scenario JSON file')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--out', default='results.json', help='results JSON file')
+    args = parser.parse_args()
+
+    scenarios = load_scenarios(args.scenarios)
+    start = time.monotonic()
+    results = run_all(scenarios, args.workers)
+    with open(args.out, 'w') as f:
+        json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'wall_time': time.monotonic() - start, 'results': results}, f, indent=1)
+    print(f'{len(results)} scenarios in {time.monotonic() - start:.1f} s, results written to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Shared memory export of the simulated robots' state, for controllers on the same machine.
+
+After every physics step the simulator copies each robot's pose, velocity, collision flag and IR
+intensities, with the sim time, into a multiprocessing.shared_memory block. Readers map the same block and
+copy the state out without any encoding or WebSocket round trip, so they can poll it at kHz rates. The
+WebSocket topics keep working for everybody else.
+
+Layout (native byte order): a HEADER record, then one ROBOT record per robot in the simulator's fleet order.
+Writes are guarded by a seqlock: the writer makes seq odd, writes, and makes it even again. A reader copies
+the records and only keeps the copy if seq was even and did not change meanwhile. Physics steps run in bursts
+(a few per frame), so a reader polling faster than the frame rate sees the last step of each burst, and
+`step` tells it how many steps it missed.
+
+Classes:
+    SharedStateExporter: creates the block and writes the fleet into it (RosSimulator does this with --shm NAME).
+    SharedStateReader: attaches to a block by name and reads consistent snapshots.
+
+Reader example:
+    reader = shm_export.SharedStateReader('create3_sim')
+    state = reader.read()
+    state.robots['x'][reader.index('juliet')], state.sim_time
+"""
+import time
+from collections import namedtuple
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy
+
+MAGIC = 0x4D533343 # b'C3SM'
+LAYOUT_VERSION = 1
+
+HEADER = numpy.dtype([
+    ('magic', 'u4'),
+    ('layout', 'u4'), # LAYOUT_VERSION
+    ('robots', 'u4'),
+    ('ir_count', 'u4'),
+    ('seq', 'u8'), # seqlock counter, odd while a write is in progress
+    ('step', 'u8'), # physics step count
+    ('sim_time', 'f8'), # simulated seconds
+], align=True)
+
+
+def robot_dtype(ir_count):
+    return numpy.dtype([
+        ('name', 'S32'),
+        ('x', 'f8'), # in meters
+        ('y', 'f8'),
+        ('theta', 'f8'), # in radians
+        ('v', 'f8'), # in m/s
+        ('theta_dot', 'f8'), # in radians per second
+        ('ir', 'f8', (ir_count,)), # IR intensities, as on the ir_intensity topic
+        ('collision', 'u1'),
+        ('collisions', 'u4'), # walls hit so far
+    ], align=True)
+
+
+# blocks this process created, their resource tracker registration belongs to the exporter
+created_here = set()
+
+# seq of the copy, and the header fields and robot records as they were at that seq
+Snapshot = namedtuple('Snapshot', 'seq step sim_time robots')
+
+
+class SharedStateExporter:
+    def __init__(self, ros, name):
+        fleet = ros.fleet
+        self.ros = ros
+        self.name = name
+        self.robot_dtype = robot_dtype(fleet.ir.shape[1])
+        size = HEADER.itemsize + len(fleet) * self.robot_dtype.itemsize
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        created_here.add(self.shm._name)
+        self.header = numpy.ndarray((), HEADER, buffer=self.shm.buf)
+        self.robots = numpy.ndarray((len(fleet),), self.robot_dtype, buffer=self.shm.buf, offset=HEADER.itemsize)
+        self.header['magic'] = MAGIC
+        self.header['layout'] = LAYOUT_VERSION
+        self.header['robots'] = len(fleet)
+        self.header['ir_count'] = fleet.ir.shape[1]
+        self.robots['name'] = [robot.name.encode('utf8')[:32] for robot in fleet.robots]
+        self.write()
+
+    def write(self):
+        # copy the fleet state in, called on the simulation thread after every physics step
+        fleet = self.ros.fleet
+        header, robots = self.header, self.robots
+        seq = int(header['seq'])
+        header['seq'] = seq + 1
+        robots['x'] = fleet.x
+        robots['y'] = fleet.y
+        robots['theta'] = fleet.theta
+        robots['v'] = fleet.v
+        robots['theta_dot'] = fleet.theta_dot
+        robots['ir'] = fleet.ir
+        robots['collision'] = fleet.collision
+        robots['collisions'] = fleet.collisions
+        header['step'] = self.ros.step_count
+        header['sim_time'] = self.ros.sim_time
+        header['seq'] = seq + 2
+
+    def close(self):
+        # readers that are still attached keep their mapping, the name is gone for new ones
+        del self.header, self.robots # the block can only be closed once no array uses its buffer
+        self.shm.close()
+        self.shm.unlink()
+        created_here.discard(self.shm._name)
+
+
+class SharedStateReader:
+    def __init__(self, name):
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # before Python 3.13 every attach is tracked, and the tracker would unlink the simulator's block when we exit.
+            # A block created in this process shares that one registration, which its exporter's unlink removes
+            self.shm = shared_memory.SharedMemory(name=name)
+            if self.shm._name not in created_here:
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.header = numpy.ndarray((), HEADER, buffer=self.shm.buf)
+        if self.header['magic'] != MAGIC or self.header['layout'] != LAYOUT_VERSION:
+            raise ValueError(f'{name} is not a simulator state block of layout {LAYOUT_VERSION}')
+        count = int(self.header['robots'])
+        self.robots = numpy.ndarray((count,), robot_dtype(int(self.header['ir_count'])), buffer=self.shm.buf, offset=HEADER.itemsize)
+        self.names = [name.decode('utf8') for name in self.robots['name']]
+
+    def index(self, robot_name):
+        # position of robot_name in Snapshot.robots
+        return self.names.index(robot_name)
+
+    def read(self, timeout=0.1):
+        # a consistent copy of the state, retried while the simulator is writing
+        deadline = time.perf_counter() + timeout
+        header = self.header
+        while True:
+            seq = int(header['seq'])
+            if not seq & 1:
+                robots = self.robots.copy()
+                step, sim_time = int(header['step']), float(header['sim_time'])
+                if int(header['seq']) == seq:
+                    return Snapshot(seq, step, sim_time, robots)
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f'{self.shm.name} stayed locked for {timeout} s, did the simulator die while writing?')
+
+    def wait(self, seq, timeout=1.0, poll=0.0002):
+        # the first snapshot newer than seq, e.g. wait(state.seq) for the next update
+        deadline = time.perf_counter() + timeout
+        while int(self.header['seq']) <= seq:
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f'no new state in {self.shm.name} for {timeout} s')
+            time.sleep(poll)
+        return self.read()
+
+    def close(self):
+        del self.header, self.robots
+        self.shm.close()
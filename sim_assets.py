@@ -0,0 +1,84 @@
+"""
+Prepared simulator assets, cached on disk so that starting many simulators does not prepare them over and over.
+
+The cache lives in $CREATE3_SIM_CACHE, or ~/.cache/create3_simulator. Entries are named after a hash of
+everything they are made from, so a changed source never hits a stale entry, and are written through a
+temporary file, so simulators starting at the same time never read half written files. When the cache
+cannot be written the assets are simply prepared every time.
+
+Functions:
+    robot_image(converted=False): the robot sprite (create3.png next to this module, rotated and scaled down), shared
+        by every robot, converted for the display once when converted is True.
+    cached_array(kind, key, build): the NumPy array build() returns for key, e.g. a map's wall distances.
+"""
+import functools
+import hashlib
+import os
+import tempfile
+
+import numpy
+import pygame
+
+ASSET_DIR = os.path.dirname(os.path.abspath(__file__))
+ROBOT_IMAGE_PATH = os.path.join(ASSET_DIR, 'create3.png')
+CACHE_DIR = os.environ.get('CREATE3_SIM_CACHE') or os.path.join(os.path.expanduser('~'), '.cache', 'create3_simulator')
+
+# how the sprite is prepared from create3.png, part of its cache key
+ROBOT_IMAGE_ROTATION = -90 # degrees, the image points up and robots drive along x
+ROBOT_IMAGE_SHRINK = 5
+
+
+def cache_path(kind, key, extension):
+    # key is bytes, the file name changes with every byte of it
+    return os.path.join(CACHE_DIR, f'{kind}-{hashlib.blake2b(key, digest_size=16).hexdigest()}{extension}')
+
+
+def write_atomically(path, write):
+    # write(file) into a temporary file that replaces path when complete, returns False if the cache is not writable
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=CACHE_DIR, suffix='.tmp', delete=False) as f:
+            temp_path = f.name
+            write(f)
+        os.replace(temp_path, path)
+        return True
+    except OSError as e:
+        print(f'Could not cache {path}: {e}')
+        return False
+
+
+@functools.lru_cache(maxsize=None)
+def robot_image(converted=False):
+    # the prepared sprite, or None if create3.png is missing. converted=True gives the one copy converted for the
+    # display (needs a video mode), so every robot in the process draws the same surface
+    if converted:
+        image = robot_image()
+        return image.convert_alpha() if image is not None else None
+    if not os.path.exists(ROBOT_IMAGE_PATH):
+        return None
+    with open(ROBOT_IMAGE_PATH, 'rb') as f:
+        source = f.read()
+    path = cache_path('create3', source + f'{ROBOT_IMAGE_ROTATION},{ROBOT_IMAGE_SHRINK}'.encode(), '.png')
+    if os.path.exists(path):
+        try:
+            return pygame.image.load(path)
+        except pygame.error:
+            pass # damaged, prepare it again
+    image = pygame.image.load(ROBOT_IMAGE_PATH)
+    image = pygame.transform.rotate(image, ROBOT_IMAGE_ROTATION)
+    image = pygame.transform.smoothscale(image, (image.get_width() // ROBOT_IMAGE_SHRINK, image.get_height() // ROBOT_IMAGE_SHRINK))
+    write_atomically(path, lambda f: pygame.image.save(image, f, 'png'))
+    return image
+
+
+def cached_array(kind, key, build):
+    # build() once for every distinct key (bytes), later calls (also from other processes) load the saved result
+    path = cache_path(kind, key, '.npy')
+    if os.path.exists(path):
+        try:
+            return numpy.load(path)
+        except (OSError, ValueError):
+            pass # damaged, build it again
+    array = build()
+    write_atomically(path, lambda f: numpy.save(f, array))
+    return array
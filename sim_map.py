@@ -0,0 +1,163 @@
+"""
+Maps for the simulator: ROS map_server style map loading, and the camera and tile cache used to draw
+maps larger than the window.
+
+Functions:
+    read_map_yaml(path): the map_server YAML fields, with map_server's defaults.
+    load_map(path): a map_server YAML file, or a plain image (PGM/PNG) with the default YAML fields.
+Classes:
+    Camera: the window's view of the map, follows a point with a dead zone so it does not move every frame.
+    TileCache: the map's display surface cut into tiles, only visible tiles are drawn and recently used ones kept.
+"""
+import os
+from collections import OrderedDict, namedtuple
+
+import numpy
+import pygame
+
+# map_server defaults, resolution is in meters per pixel and origin is the (x, y, yaw) of the lower left pixel
+MAP_DEFAULTS = {'resolution': 0.05, 'origin': [0.0, 0.0, 0.0], 'negate': 0, 'occupied_thresh': 0.65, 'free_thresh': 0.196}
+
+FREE_COLOR = (255, 255, 255)
+UNKNOWN_COLOR = (205, 205, 205)
+
+# surface: colored map for display, wall_map: occupancy indexed [x, y], origin: (x, y) in meters of the lower left corner
+Map = namedtuple('Map', 'surface wall_map resolution origin')
+
+
+def read_map_yaml(path):
+    with open(path) as f:
+        text = f.read()
+    try:
+        import yaml # only imported when a map is loaded, it takes a while
+    except ImportError:
+        yaml = None
+    if yaml is not None:
+        fields = yaml.safe_load(text)
+    else:
+        # map_server files are flat "key: value" lines, origin is a [x, y, yaw] list
+        fields = {}
+        for line in text.splitlines():
+            key, _, value = line.partition('#')[0].partition(':')
+            if value.strip():
+                value = value.strip()
+                if value.startswith('['):
+                    value = [float(v) for v in value.strip('[]').split(',')]
+                else:
+                    try:
+                        value = float(value)
+                    except ValueError:
+                        value = value.strip('\'"')
+                fields[key.strip()] = value
+    return {**MAP_DEFAULTS, **fields}
+
+
+def load_map(path, wall_color=(25, 123, 189)):
+    # occupied cells (occupancy above occupied_thresh) are walls, unknown cells are drawn grey but are free space
+    if path.lower().endswith(('.yaml', '.yml')):
+        fields = read_map_yaml(path)
+        image_path = os.path.join(os.path.dirname(path), fields['image'])
+    else:
+        fields, image_path = dict(MAP_DEFAULTS), path
+    image = pygame.image.load(image_path)
+    value = pygame.surfarray.array3d(image).sum(axis=2, dtype=numpy.float32) / (3 * 255) # [x, y], 1 is white
+    occupancy = value if fields['negate'] else 1 - value
+    wall_map = occupancy > fields['occupied_thresh']
+    # 0 unknown, 1 free, 2 wall, looked up in the palette
+    cells = numpy.where(wall_map, numpy.uint8(2), (occupancy < fields['free_thresh']).view(numpy.uint8))
+    colors = numpy.array([UNKNOWN_COLOR, FREE_COLOR, wall_color], dtype=numpy.uint8)[cells]
+    origin = fields['origin']
+    return Map(pygame.surfarray.make_surface(colors), wall_map, float(fields['resolution']), (float(origin[0]), float(origin[1])))
+
+
+class Camera:
+    """
+    Which part of the map (in display pixels) the window shows. A map smaller than the window is centred.
+    follow() only moves the view when the point leaves the central dead zone, so most frames keep the
+    same view and only the robots need redrawing.
+    """
+
+    def __init__(self, view_size, world_size, dead_zone=0.5):
+        self.width, self.height = view_size
+        self.world_width, self.world_height = world_size
+        self.dead_zone = dead_zone # fraction of the view around its centre where the point can move freely
+        self.left = self.top = 0
+        self.clamp()
+
+    def clamp(self):
+        self.left = self.clamp_axis(self.left, self.width, self.world_width)
+        self.top = self.clamp_axis(self.top, self.height, self.world_height)
+
+    @staticmethod
+    def clamp_axis(start, view, world):
+        if world <= view:
+            return -((view - world) // 2)
+        return min(max(start, 0), world - view)
+
+    def follow(self, x, y):
+        # keep the display point (x, y) inside the dead zone, returns True if the view moved
+        old = (self.left, self.top)
+        margin_x = self.width * (1 - self.dead_zone) / 2
+        margin_y = self.height * (1 - self.dead_zone) / 2
+        self.left = int(min(max(self.left, x - self.width + margin_x), x - margin_x))
+        self.top = int(min(max(self.top, y - self.height + margin_y), y - margin_y))
+        self.clamp()
+        return (self.left, self.top) != old
+
+    def rect(self):
+        return pygame.Rect(self.left, self.top, self.width, self.height)
+
+
+class TileCache:
+    """
+    The map's display surface, scaled by `scale` display pixels per map pixel and cut into tiles of about
+    display_tile display pixels. Tiles are made when first drawn and the most recently used max_tiles are
+    kept, so drawing costs the same for any map size.
+    """
+
+    def __init__(self, surface, scale=1.0, display_tile=256, max_tiles=128):
+        self.surface = surface
+        self.scale = scale
+        self.tile_size = max(1, round(display_tile / scale)) # in map pixels
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict() # (column, row) -> (display position, surface)
+        width, height = surface.get_size()
+        self.columns = -(-width // self.tile_size)
+        self.rows = -(-height // self.tile_size)
+        self.display_size = (round(width * scale), round(height * scale))
+
+    def edge(self, index):
+        # display coordinate of the edge before tile index, rounded the same way for neighbouring tiles so they never leave gaps
+        return round(index * self.tile_size * self.scale)
+
+    def tile(self, column, row):
+        key = (column, row)
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+            return tile
+        source = pygame.Rect(column * self.tile_size, row * self.tile_size, self.tile_size, self.tile_size).clip(self.surface.get_rect())
+        image = self.surface.subsurface(source)
+        left, top = self.edge(column), self.edge(row)
+        if self.scale != 1:
+            size = (round(source.right * self.scale) - left, round(source.bottom * self.scale) - top)
+            image = pygame.transform.scale(image, size)
+        tile = ((left, top), image)
+        self.tiles[key] = tile
+        if len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+        return tile
+
+    def draw(self, target, camera, fill_color=(0, 0, 0)):
+        # draw the tiles that camera sees onto target (a view sized surface)
+        target.fill(fill_color)
+        display_tile = self.tile_size * self.scale
+        # one extra tile on each side, tile edges are rounded to whole display pixels
+        first_column = max(0, int(camera.left // display_tile) - 1)
+        first_row = max(0, int(camera.top // display_tile) - 1)
+        last_column = min(self.columns - 1, int((camera.left + camera.width) // display_tile) + 1)
+        last_row = min(self.rows - 1, int((camera.top + camera.height) // display_tile) + 1)
+        for column in range(first_column, last_column + 1):
+            for row in range(first_row, last_row + 1):
+                (left, top), image = self.tile(column, row)
+                target.blit(image, (left - camera.left, top - camera.top))
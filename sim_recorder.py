@@ -0,0 +1,143 @@
+"""
+Record and replay of the simulator's WebSocket traffic.
+
+The log is a binary file holding one recorded session: a magic header, then one record per message, each a fixed
+header (payload length, wall clock time, physics step, kind) followed by the raw payload bytes.
+
+Classes:
+    Recorder: appends records from a background writer thread, so the frame loop never waits on disk.
+    LogReader: iterates the records of a log through a memory map.
+    Replay: feeds the recorded inbound messages back into a simulator at the physics step they arrived on.
+"""
+import mmap
+import queue
+import struct
+import threading
+import time
+from collections import namedtuple
+
+import ros_messages
+
+MAGIC = b'C3SIMLOG\x01'
+# payload length, seconds on the recording simulator's topic clock (its wall clock unless paused) since the recording started, physics step, kind
+RECORD_HEADER = struct.Struct('<IdQB')
+
+# record kinds, BINARY is or-ed in for binary WebSocket frames
+INBOUND = 0
+OUTBOUND = 1
+BINARY = 2
+
+Record = namedtuple('Record', 'wall_time step kind payload')
+
+
+class Recorder:
+    def __init__(self, path, clock=time.monotonic):
+        # clock() in seconds times the records, the simulator passes its topic clock so replays see the same timeouts
+        self.path = path
+        self.clock = clock
+        # one session per log, step counts and wall times start at 0 for every recording
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.start = clock()
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def record(self, kind, step, payload):
+        # called from the frame loop and network callbacks, only queues the record
+        self.queue.put((self.clock() - self.start, step, kind, bytes(payload)))
+
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            # write everything that queued up meanwhile in one go
+            while not self.queue.empty():
+                records.append(self.queue.get())
+            closing = records[-1] is None
+            chunks = []
+            for record in records:
+                if record is None:
+                    continue
+                wall_time, step, kind, payload = record
+                chunks.append(RECORD_HEADER.pack(len(payload), wall_time, step, kind))
+                chunks.append(payload)
+            self.file.write(b''.join(chunks))
+            self.file.flush()
+            if closing:
+                self.file.close()
+                return
+
+    def close(self):
+        # write what is still queued and close the file
+        self.queue.put(None)
+        self.thread.join()
+
+
+class LogReader:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a simulator log')
+
+    def __iter__(self):
+        offset = len(MAGIC)
+        end = len(self.map)
+        while offset + RECORD_HEADER.size <= end:
+            length, wall_time, step, kind = RECORD_HEADER.unpack_from(self.map, offset)
+            offset += RECORD_HEADER.size
+            if offset + length > end:
+                break # the recorder was cut off mid record
+            yield Record(wall_time, step, kind, self.map[offset:offset + length])
+            offset += length
+
+    def inbound(self):
+        return (record for record in self if not record.kind & OUTBOUND)
+
+
+class Replay:
+    """
+    Feeds the inbound publishes of a log into a simulator, each one before the physics step that
+    followed its arrival in the recorded run, so a replay is deterministic at any real time factor.
+    clock_ns() follows the recorded wall clock, so topic rates and timeouts see the recorded timing.
+    """
+
+    def __init__(self, path):
+        self.reader = LogReader(path)
+        self.records = iter(self.reader)
+        self.next_record = next(self.records, None)
+        self.last_step = 0 # of the last record, step counts start again at 0 after a /sim/reset
+        for record in self.reader:
+            self.last_step = record.step
+        self.now_ns = 0
+
+    @property
+    def finished(self):
+        return self.next_record is None
+
+    def clock_ns(self):
+        # recorded wall clock time of the last record fed, in ns
+        return self.now_ns
+
+    def feed(self, ros):
+        # publish every inbound record that arrived before the simulator's current step
+        while self.next_record is not None and self.next_record.step <= ros.step_count:
+            record = self.next_record
+            self.next_record = next(self.records, None)
+            self.now_ns = int(record.wall_time * 1e9)
+            if record.kind & OUTBOUND:
+                continue
+            try:
+                if record.kind & BINARY:
+                    message = ros_messages.cbor_loads(record.payload)
+                else:
+                    message = ros_messages.loads(record.payload)
+                op = message.get('op', 'publish')
+                if op == 'publish':
+                    ros.publish_inbound(message.get('topic', ''), message.get('msg', None))
+                elif op == 'call_service' and message.get('service') == '/sim/reset':
+                    # /sim/step calls need no replay, their steps are at the recorded step counts anyway
+                    ros.reset()
+            except Exception as e:
+                # the recorded run got the same bad frame, and reported it the same way
+                ros.inbound_error(f'replayed frame of step {record.step}', e)
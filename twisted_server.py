@@ -0,0 +1,82 @@
+"""
+Twisted engine for the simulator, the default: the WebSocket server and the frame loop (a LoopingCall)
+share the reactor thread.
+
+Usage:
+    python create3_simulator.py
+or from code:
+    twisted_server.listen(ros, port)  # then run the reactor yourself
+    twisted_server.run(ros, port)
+"""
+from autobahn.twisted.websocket import WebSocketServerFactory, WebSocketServerProtocol
+from twisted.internet import reactor, task
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+
+from rosbridge import RosbridgeProtocol
+
+
+@implementer(IPushProducer)
+class WebSocketProtocol(RosbridgeProtocol, WebSocketServerProtocol):
+    """
+    A rosbridge client on the Twisted reactor, which also runs the frame loop. Registered as a push
+    producer on its transport, so Twisted pauses it when the transport's write buffer is full.
+    """
+
+    def onConnect(self, request):
+        self.peer = request.peer
+        print(f'CONNECTED to {request.peer}')
+
+    def onOpen(self):
+        # register with the simulator so we can receive the topics we subscribe to
+        self.ros.add_client(self)
+        self.transport.bufferSize = self.ros.client_high_water
+        self.transport.registerProducer(self, True)
+
+    def onClose(self, wasClean, code, reason):
+        print(f'DISCONNECTED from {self.peer}')
+        self.ros.remove_client(self)
+
+    def send_encoded(self, data, is_binary=False, topic_name=None):
+        # send an already encoded message, the same bytes are shared by every subscriber
+        if self.paused:
+            self.queue_latest(topic_name, data, is_binary)
+        else:
+            self.write_message(data, is_binary)
+
+    def pauseProducing(self):
+        # the transport buffer is over the high-water mark
+        self.paused = True
+
+    def resumeProducing(self):
+        # the transport buffer drained
+        self.paused = False
+        self.send_pending()
+
+    def stopProducing(self):
+        self.pending.clear()
+
+    def onMessage(self, payload, isBinary):
+        # runs right away on the reactor, which is the simulation thread; topic callbacks still wait for the frame loop
+        self.receive(payload, isBinary)()
+
+
+def listen(ros, port, ip='0.0.0.0'):
+    # Set up the WebSocket server for ros, port 0 picks a free port. Returns the listening port
+    factory = WebSocketServerFactory(f"ws://{ip}:{port}" if port else f"ws://{ip}")
+    factory.protocol = lambda: WebSocketProtocol(ros)
+    return reactor.listenTCP(port, factory, interface=ip)
+
+
+def run(ros, port, ip='0.0.0.0'):
+    # serve ros and run its frame loop on the reactor until the simulator exits
+    listen(ros, port, ip)
+
+    # Integrate Pygame loop with Twisted reactor
+    pygame_task = task.LoopingCall(ros.run_with_exit, reactor)
+    pygame_task.start(ros.loop_interval)
+    try:
+        reactor.run()
+    finally:
+        # also after Ctrl-C or SIGTERM stopped the reactor, so the log and the shared memory block are closed
+        ros.close()